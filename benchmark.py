@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+#
+# Time how mapall behaves on large synthetic inventories
+# The inventory is written into the .cache layout that mapall reads so
+# no aws calls are made
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import mapall
+
+
+###############################################################################
+def tags(name, stack):
+    return [
+        {'Key': 'Name', 'Value': name},
+        {'Key': 'aws:cloudformation:stack-name', 'Value': stack},
+        {'Key': 'aws:cloudformation:stack-id', 'Value': 'arn:aws:cloudformation:ap-southeast-2:123456789012:stack/%s' % stack},
+        {'Key': 'aws:cloudformation:logical-id', 'Value': name},
+        ]
+
+
+###############################################################################
+def generate(scale, seed=0):
+    """ Return the describe-* output for an account with scale instances """
+    rnd = random.Random(seed)
+    nvpcs = max(2, scale // 500)
+    nsubnets = max(4, scale // 50)
+    nsgs = max(4, scale // 2)
+    azs = ['ap-southeast-2a', 'ap-southeast-2b', 'ap-southeast-2c']
+    when = '2000-01-01T01:00:00.000Z'
+
+    vpcs = []
+    for v in range(nvpcs):
+        vpcs.append({
+            'CidrBlock': '10.%d.0.0/16' % v, 'DhcpOptionsId': 'dopt-00000000', 'InstanceTenancy': 'default',
+            'IsDefault': False, 'State': 'available', 'VpcId': 'vpc-%08x' % v})
+
+    subnets = []
+    for s in range(nsubnets):
+        v = s % nvpcs
+        subnets.append({
+            'AvailabilityZone': azs[s % len(azs)], 'AvailableIpAddressCount': 200,
+            'CidrBlock': '10.%d.%d.0/24' % (v, s // nvpcs), 'DefaultForAz': False, 'MapPublicIpOnLaunch': False,
+            'State': 'available', 'SubnetId': 'subnet-%08x' % s, 'Tags': tags('Subnet%d' % s, 'stack%d' % v),
+            'VpcId': 'vpc-%08x' % v})
+
+    sgs = []
+    for g in range(nsgs):
+        sgs.append({
+            'Description': 'Security group %d for the synthetic benchmark inventory' % g,
+            'GroupId': 'sg-%08x' % g, 'GroupName': 'sg%d' % g, 'OwnerId': '123456789012',
+            'IpPermissions': [
+                {'ToPort': 443, 'IpProtocol': 'tcp', 'IpRanges': [{'CidrIp': '0.0.0.0/0'}], 'UserIdGroupPairs': [], 'FromPort': 443},
+                {'ToPort': 22, 'IpProtocol': 'tcp', 'IpRanges': [],
+                 'UserIdGroupPairs': [{'GroupId': 'sg-%08x' % rnd.randrange(nsgs), 'UserId': '123456789012'}], 'FromPort': 22}],
+            'IpPermissionsEgress': [
+                {'IpProtocol': '-1', 'IpRanges': [{'CidrIp': '0.0.0.0/0'}], 'UserIdGroupPairs': []}],
+            'Tags': tags('SG%d' % g, 'stack%d' % (g % nvpcs)), 'VpcId': 'vpc-%08x' % (g % nvpcs)})
+
+    reservations, volumes, nics = [], [], []
+    for i in range(scale):
+        subnet = subnets[i % nsubnets]
+        instid = 'i-%08x' % i
+        ip = subnet['CidrBlock'].replace('0/24', '%d' % (4 + (i // nsubnets) % 250))
+        groups = [{'GroupName': 'sg', 'GroupId': 'sg-%08x' % rnd.randrange(nsgs)}]
+        vols = []
+        for d in range(5):
+            volid = 'vol-%08x' % (i * 5 + d)
+            device = '/dev/sd%s' % 'abcde'[d]
+            vols.append({
+                'DeviceName': device,
+                'Ebs': {'Status': 'attached', 'DeleteOnTermination': True, 'VolumeId': volid, 'AttachTime': when}})
+            volumes.append({
+                'Attachments': [{'AttachTime': when, 'InstanceId': instid, 'VolumeId': volid, 'State': 'attached',
+                                 'DeleteOnTermination': True, 'Device': device}],
+                'AvailabilityZone': subnet['AvailabilityZone'], 'CreateTime': when, 'Size': rnd.choice([8, 20, 100]),
+                'SnapshotId': 'snap-00000000', 'State': 'in-use', 'VolumeId': volid, 'VolumeType': 'standard'})
+        nic = {
+            'Attachment': {'Status': 'attached', 'DeviceIndex': 0, 'AttachTime': when, 'InstanceId': instid,
+                           'DeleteOnTermination': True, 'AttachmentId': 'eni-attach-%08x' % i, 'InstanceOwnerId': '123456789012'},
+            'AvailabilityZone': subnet['AvailabilityZone'], 'Description': None, 'Groups': groups,
+            'MacAddress': 'aa:bb:cc:dd:ee:ff', 'NetworkInterfaceId': 'eni-%08x' % i, 'OwnerId': '123456789012',
+            'PrivateDnsName': 'ip-%s.ap-southeast-2.compute.internal' % ip.replace('.', '-'), 'PrivateIpAddress': ip,
+            'PrivateIpAddresses': [{'PrivateIpAddress': ip, 'Primary': True}], 'RequesterManaged': False,
+            'SourceDestCheck': True, 'Status': 'in-use', 'SubnetId': subnet['SubnetId'], 'TagSet': [],
+            'VpcId': subnet['VpcId']}
+        nics.append(nic)
+        reservations.append({'Instances': [{
+            'AmiLaunchIndex': 0, 'Architecture': 'x86_64', 'BlockDeviceMappings': vols, 'ClientToken': 'token%d' % i,
+            'EbsOptimized': False, 'Hypervisor': 'xen', 'ImageId': 'ami-00000000', 'InstanceId': instid,
+            'InstanceType': 't1.micro', 'KeyName': 'KeyName', 'LaunchTime': when, 'Monitoring': {'State': 'disabled'},
+            'NetworkInterfaces': [nic], 'Placement': {'GroupName': None, 'Tenancy': 'default', 'AvailabilityZone': subnet['AvailabilityZone']},
+            'PrivateDnsName': nic['PrivateDnsName'], 'PrivateIpAddress': ip, 'ProductCodes': [], 'PublicDnsName': '',
+            'RootDeviceName': '/dev/sda', 'RootDeviceType': 'ebs', 'SecurityGroups': groups, 'SourceDestCheck': True,
+            'State': {'Code': 16, 'Name': 'running'}, 'StateTransitionReason': None, 'SubnetId': subnet['SubnetId'],
+            'Tags': tags('host%d' % i, 'stack%d' % (i % nvpcs)), 'VirtualizationType': 'paravirtual', 'VpcId': subnet['VpcId']}]})
+
+    routetables, nacls, igws = [], [], []
+    for v in range(nvpcs):
+        vpcid = 'vpc-%08x' % v
+        members = [s for s in subnets if s['VpcId'] == vpcid]
+        routetables.append({
+            'Associations': [{'SubnetId': s['SubnetId'], 'RouteTableAssociationId': 'rtbassoc-%s' % s['SubnetId'][7:],
+                              'RouteTableId': 'rtb-%08x' % v} for s in members] + [{'Main': True, 'RouteTableId': 'rtb-%08x' % v}],
+            'PropagatingVgws': [], 'RouteTableId': 'rtb-%08x' % v,
+            'Routes': [
+                {'GatewayId': 'local', 'DestinationCidrBlock': '10.%d.0.0/16' % v, 'State': 'active', 'Origin': 'CreateRouteTable'},
+                {'GatewayId': 'igw-%08x' % v, 'DestinationCidrBlock': '0.0.0.0/0', 'State': 'active', 'Origin': 'CreateRoute'}],
+            'Tags': [], 'VpcId': vpcid})
+        nacls.append({
+            'Associations': [{'SubnetId': s['SubnetId'], 'NetworkAclId': 'acl-%08x' % v,
+                              'NetworkAclAssociationId': 'aclassoc-%s' % s['SubnetId'][7:]} for s in members],
+            'NetworkAclId': 'acl-%08x' % v, 'VpcId': vpcid, 'Tags': [], 'IsDefault': True,
+            'Entries': [
+                {'CidrBlock': '0.0.0.0/0', 'RuleNumber': 100, 'Protocol': '6', 'Egress': False, 'RuleAction': 'allow',
+                 'PortRange': {'From': 443, 'To': 443}},
+                {'CidrBlock': '0.0.0.0/0', 'RuleNumber': 32767, 'Protocol': '-1', 'Egress': False, 'RuleAction': 'deny'},
+                {'CidrBlock': '0.0.0.0/0', 'RuleNumber': 100, 'Protocol': '-1', 'Egress': True, 'RuleAction': 'allow'}]})
+        igws.append({
+            'Attachments': [{'State': 'available', 'VpcId': vpcid}], 'InternetGatewayId': 'igw-%08x' % v,
+            'Tags': tags('InternetGateway', 'stack%d' % v)})
+
+    dbs = []
+    for d in range(max(1, scale // 100)):
+        vpcid = 'vpc-%08x' % (d % nvpcs)
+        members = [s for s in subnets if s['VpcId'] == vpcid][:2]
+        dbs.append({
+            'AllocatedStorage': 5, 'AvailabilityZone': members[0]['AvailabilityZone'], 'DBInstanceClass': 'db.t1.micro',
+            'DBInstanceIdentifier': 'db%d' % d, 'DBInstanceStatus': 'available', 'DBName': 'db%d' % d,
+            'DBSubnetGroup': {
+                'DBSubnetGroupDescription': 'default', 'DBSubnetGroupName': 'default', 'SubnetGroupStatus': 'Complete',
+                'Subnets': [{'SubnetStatus': 'Active', 'SubnetIdentifier': s['SubnetId'],
+                             'SubnetAvailabilityZone': {'Name': s['AvailabilityZone']}} for s in members],
+                'VpcId': vpcid},
+            'Endpoint': {'Port': 3306, 'Address': 'db%d.rds.amazonaws.com' % d}, 'Engine': 'mysql', 'EngineVersion': '5.6.13',
+            'MultiAZ': False, 'PubliclyAccessible': False,
+            'VpcSecurityGroups': [{'Status': 'active', 'VpcSecurityGroupId': 'sg-%08x' % rnd.randrange(nsgs)}]})
+
+    elbs = []
+    for e in range(max(1, scale // 50)):
+        vpcid = 'vpc-%08x' % (e % nvpcs)
+        members = [s['SubnetId'] for s in subnets if s['VpcId'] == vpcid][:2]
+        elbs.append({
+            'AvailabilityZones': azs[:2], 'BackendServerDescriptions': [], 'CreatedTime': when, 'DNSName': 'elb%d' % e,
+            'HealthCheck': {'HealthyThreshold': 2, 'Interval': 30, 'Target': 'TCP:80', 'Timeout': 5, 'UnhealthyThreshold': 2},
+            'Instances': [{'InstanceId': r['Instances'][0]['InstanceId']} for r in reservations[e::max(1, scale // 50)][:4]
+                          if r['Instances'][0]['VpcId'] == vpcid],
+            'ListenerDescriptions': [{'Listener': {'InstancePort': 80, 'Protocol': 'HTTP', 'LoadBalancerPort': 80,
+                                                   'InstanceProtocol': 'HTTP'}, 'PolicyNames': []}],
+            'LoadBalancerName': 'elb%d' % e, 'Scheme': 'internal', 'SecurityGroups': ['sg-%08x' % rnd.randrange(nsgs)],
+            'SourceSecurityGroup': {'OwnerAlias': '123456789012', 'GroupName': 'sg'}, 'Subnets': members, 'VPCId': vpcid})
+
+    return {
+        'describe-vpcs': {'Vpcs': vpcs},
+        'describe-internet-gateways': {'InternetGateways': igws},
+        'describe-network-interfaces': {'NetworkInterfaces': nics},
+        'describe-instances': {'Reservations': reservations},
+        'describe-subnets': {'Subnets': subnets},
+        'describe-volumes': {'Volumes': volumes},
+        'describe-route-tables': {'RouteTables': routetables},
+        'describe-security-groups': {'SecurityGroups': sgs},
+        'describe-network-acls': {'NetworkAcls': nacls},
+        'describe-db-instances': {'DBInstances': dbs},
+        'describe-load-balancers': {'LoadBalancerDescriptions': elbs},
+        }
+
+
+###############################################################################
+def write_cache(inventory):
+    """ Write the inventory to where awscmd() will find it in .cache """
+    for name, area, cmd, key, builder in mapall.resources:
+        fullcmd, cachefile = mapall.cachename(cmd, area)
+        mapall.cache_write(cachefile, fullcmd, json.dumps(inventory[cmd]))
+
+
+###############################################################################
+def reset():
+    """ Forget everything mapall has loaded """
+    for registry in (mapall.objects, mapall.typekeys, mapall.attached,
+                     mapall.subnetassoc, mapall.sgmembers, mapall.bytype):
+        registry.clear()
+
+
+###############################################################################
+def timed(results, phase, func, *args):
+    start = time.time()
+    ans = func(*args)
+    results[phase] = time.time() - start
+    return ans
+
+
+###############################################################################
+def bench(scale, procs):
+    """ Time each phase at one scale - run in a scratch directory """
+    results = {}
+    timed(results, 'generate', write_cache, generate(scale))
+    margs = mapall.parseArgs(['--procs', str(procs)])
+    reset()
+    timed(results, 'map_region', mapall.map_all, margs)
+    results['objects'] = len(mapall.objects)
+
+    with open(os.devnull, 'w') as null:
+        timed(results, 'generate_map', mapall.generate_map, null, margs)
+        margs.security = True
+        timed(results, 'generate_map_security', mapall.generate_map, null, margs)
+        margs.security = False
+        timed(results, 'generate_secmap', mapall.generate_secmap, 'i-%08x' % 0, null, margs)
+
+    jobs = []
+    for vpc in mapall.bytype.get(mapall.VPC, []):
+        vargs = mapall.copy.copy(margs)
+        vargs.vpc = vpc.name
+        jobs.append(('%s.dot' % vpc.name, vargs, vpc.scope, None, None))
+    timed(results, 'iterate_vpc', mapall.render_all, jobs, margs)
+    return results
+
+
+###############################################################################
+def parseArgs():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--scales', default='100,1000,10000',
+        help="Comma separated list of how many instances to benchmark with [100,1000,10000]")
+    parser.add_argument(
+        '--procs', default=4, type=int,
+        help="How many processes to use for --iterate [4]")
+    parser.add_argument(
+        '--output', default=sys.stdout, type=argparse.FileType('w'),
+        help="Which file to write the json results to [stdout]")
+    parser.add_argument(
+        '--keep', default=False, action='store_true',
+        help="Keep the scratch directories with the generated .cache")
+    return parser.parse_args()
+
+
+###############################################################################
+def main():
+    args = parseArgs()
+    cwd = os.getcwd()
+    results = []
+    for scale in [int(x) for x in args.scales.split(',')]:
+        tmpdir = tempfile.mkdtemp(prefix='aws-map-bench-')
+        os.chdir(tmpdir)
+        try:
+            res = bench(scale, args.procs)
+        finally:
+            os.chdir(cwd)
+            if not args.keep:
+                shutil.rmtree(tmpdir)
+        res['scale'] = scale
+        sys.stderr.write("%d instances: %s\n" % (scale, " ".join(
+            ["%s=%.2fs" % (k, v) for k, v in sorted(res.items()) if isinstance(v, float)])))
+        results.append(res)
+    json.dump({'time': time.time(), 'results': results}, args.output, indent=2, sort_keys=True)
+    args.output.write("\n")
+
+###############################################################################
+if __name__ == '__main__':
+    main()
+
+#EOF
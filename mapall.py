@@ -4,32 +4,156 @@
 # Images are available from http://aws.amazon.com/architecture/icons/
 
 import argparse
+import BaseHTTPServer
+import contextlib
+import copy
+import errno
+import itertools
 import json
 import md5
 import os
+import re
+import resource
+import shlex
+import socket
+import SocketServer
+import sqlite3
+import struct
+import subprocess
+import StringIO
 import sys
+import tempfile
+import threading
+import time
+import urlparse
 import netaddr
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import boto3
+    import botocore
+    import botocore.config
+    import jmespath
+except ImportError:
+    boto3 = None
 
 objects = {}
-clusternum = 0
+typekeys = {}       # (scope, resource type) -> keys of the objects built from them
+attached = {}       # instance key -> objects attached to it
+subnetassoc = {}    # subnet key -> route tables and nacls associated with it
+sgmembers = {}      # security group key -> objects in it
+bytype = {}         # class -> its objects in sortkey order
 awsflags = []
 nocache = False
-secGrpToDraw = set()
-
+backend = 'cli'     # How aws commands are run - the aws cli or boto3 in process
+apiclients = {}     # (pid, service, profile, region, endpoint) -> boto3 client
+apilock = threading.Lock()
+cliSwitches = set([     # aws cli options that don't take a value
+    'debug', 'no-paginate', 'no-verify-ssl', 'no-sign-request', 'no-cli-pager', 'cli-auto-prompt', 'no-cli-auto-prompt'])
+profiling = None    # Timings and counts if we were asked for them
+
+graphvizFormats = ['png', 'svg', 'pdf']
 colours = ['azure', 'coral', 'wheat', 'deepskyblue', 'firebrick', 'gold', 'green', 'plum', 'salmon', 'sienna']
 
 
+###############################################################################
+###############################################################################
+###############################################################################
+class DotFile(object):
+    """ Somewhere to draw a map and what is needed while drawing it, so
+    that drawing one map doesn't affect any other
+
+    Writes are collected and only written to fh in large chunks - or kept
+    until asked for with getvalue() if there is no fh """
+    bufsize = 1024 * 1024
+
+    def __init__(self, fh, args):
+        self.fh = fh
+        self.args = args
+        self.clusternum = 0
+        self.secgroups = set()      # Security groups that need to be drawn
+        self.drawn = set()          # Security groups that have been
+        self.buf = []
+        self.size = 0
+        self.writes = 0
+        self.objcounts = {}         # Class name -> objects drawn
+        self.edgecounts = {}        # Class name -> edges drawn
+        self.linked = set()         # Keys of the objects edges were drawn to or from
+
+    def count(self, counts, obj):
+        name = obj.__class__.__name__
+        counts[name] = counts.get(name, 0) + 1
+
+    def write(self, s):
+        self.buf.append(s)
+        self.size += len(s)
+        self.writes += 1
+        if self.fh and self.size > self.bufsize:
+            self.flush()
+
+    def flush(self):
+        if self.fh:
+            self.fh.write("".join(self.buf))
+            self.buf = []
+            self.size = 0
+
+    def getvalue(self):
+        return "".join(self.buf)
+
+    def nextcluster(self):
+        self.clusternum += 1
+        return self.clusternum - 1
+
+
 ###############################################################################
 ###############################################################################
 ###############################################################################
 class Dot(object):
+    """ Only the fields of the api data that are used are kept, so that
+    large inventories don't hold everything aws tells us """
+    __slots__ = ('name', 'scope', 'values', 'tagd', 'dotname', 'digested')
+    idkey = None        # Field that has the id of this object
+    fields = ()         # Fields that are kept
+
     def __init__(self, data, args):
-        self.data = data
-        self.args = args
+        self.name = data[self.idkey]
+        self.scope = ''     # Which profile/region this came from if mapping many
+        self.values = tuple([data.get(f) for f in self.fields])
+        self.tagd = None
+        if 'Tags' in data:
+            self.tagd = dict([(t['Key'], t['Value']) for t in data['Tags']])
+        self.dotname = None
+        self.digested = None
+
+    ##########################################################################
+    @property
+    def key(self):
+        """ Name of this object in the objects registry """
+        return scopedkey(self.scope, self.name)
+
+    ##########################################################################
+    @property
+    def sortkey(self):
+        """ Order objects the same way every run """
+        return (self.scope, self.name)
+
+    ##########################################################################
+    def obj(self, name):
+        """ Look up another object from the same profile/region as this """
+        return objects[scopedkey(self.scope, name)]
 
     ##########################################################################
     def __getitem__(self, key):
-        return self.data.get(key, None)
+        if key == self.idkey:
+            return self.name
+        try:
+            return self.values[self.fields.index(key)]
+        except ValueError:
+            return None
 
     ##########################################################################
     def draw(self, fh):
@@ -38,15 +162,79 @@ class Dot(object):
     ##########################################################################
     def mn(self, s=None):
         """ Munge name to be dottable """
-        if not s:
-            s = self.name
-        s = s.replace('-', '_')
-        s = s.replace("'", '"')
-        return s
+        if not s or s == self.name:
+            if self.dotname is None:
+                self.dotname = munge(self.name, self.scope)
+            return self.dotname
+        return munge(s, self.scope)
 
     ##########################################################################
     def partOfInstance(self, instid):
-        return False
+        return instid in self.attachedTo()
+
+    ##########################################################################
+    def attachedTo(self):
+        """ Ids of the instances this is part of """
+        return []
+
+    ##########################################################################
+    def subnetAssociations(self):
+        """ Ids of the subnets this is associated with """
+        return []
+
+    ##########################################################################
+    def securityGroups(self):
+        """ Ids of the security groups this is a member of """
+        return []
+
+    ##########################################################################
+    def vpcIds(self):
+        """ Ids of the vpcs this is in """
+        if self['VpcId']:
+            return [self['VpcId']]
+        return []
+
+    ##########################################################################
+    def addresses(self):
+        """ The private ips of this """
+        if self['PrivateIpAddress']:
+            return [self['PrivateIpAddress']]
+        return []
+
+    ##########################################################################
+    def subnetIds(self):
+        """ Ids of the subnets this is in or associated with """
+        if self['SubnetId']:
+            return [self['SubnetId']]
+        return self.subnetAssociations()
+
+    ##########################################################################
+    def refs(self):
+        """ The (kind, id) of everything this is indexed by in the inventory """
+        refs = set([(self.idkey, self.name)])
+        refs.update([('VpcId', x) for x in self.vpcIds()])
+        refs.update([('SubnetId', x) for x in self.subnetIds()])
+        refs.update([('InstanceId', x) for x in self.attachedTo()])
+        refs.update([('GroupId', x) for x in self.securityGroups()])
+        return sorted(refs)
+
+    ##########################################################################
+    def data(self):
+        """ As much of the api data this was built from as was kept - so it
+        can be built again from the inventory """
+        data = dict([(f, v) for f, v in zip(self.fields, self.values) if v is not None])
+        data[self.idkey] = self.name
+        if self.tagd is not None:
+            data['Tags'] = [{'Key': k, 'Value': v} for k, v in sorted(self.tagd.items())]
+        return data
+
+    ##########################################################################
+    def digest(self):
+        """ Hash of what this was built from - not of the objects it refers to """
+        if self.digested is None:
+            blob = json.dumps([self.__class__.__name__, self.scope, self.data()], sort_keys=True)
+            self.digested = md5.md5(blob).hexdigest()
+        return self.digested
 
     ##########################################################################
     def inSubnet(self, subnet):
@@ -64,18 +252,17 @@ class Dot(object):
         if blockstr:
             blockstr = '[ %s ]' % blockstr
         fh.write("%s -> %s %s;\n" % (self.mn(a), self.mn(b), blockstr))
+        fh.count(fh.edgecounts, self)
+        fh.linked.update([scopedkey(self.scope, a), scopedkey(self.scope, b)])
 
     ##########################################################################
     def tags(self, key=None):
-        tagd = {}
-        if 'Tags' not in self.data:
+        if self.tagd is None:
             return None
-        for t in self['Tags']:
-            tagd[t['Key']] = t['Value']
         if key:
-            return tagd.get(key, None)
+            return self.tagd.get(key, None)
         else:
-            return tagd
+            return self.tagd
 
     ##########################################################################
     def inVpc(self, vpc):
@@ -85,6 +272,12 @@ class Dot(object):
     def relevent_to_ip(self, ip):
         return False
 
+    ##########################################################################
+    def cidrs(self):
+        """ The (cidr, description) of everything in this that covers
+        a range of addresses """
+        return []
+
     ##########################################################################
     def rank(self, fh):
         fh.write(self.mn())
@@ -129,16 +322,18 @@ class NetworkAcl(Dot):
         "IsDefault": true
     }
     """
-    def __init__(self, instance, args):
-        self.data = instance
-        self.name = instance['NetworkAclId']
-        self.args = args
+    __slots__ = ()
+    idkey = 'NetworkAclId'
+    fields = ('Associations', 'Entries', 'VpcId')
 
     def inVpc(self, vpc):
         if vpc and self['VpcId'] != vpc:
             return False
         return True
 
+    def subnetAssociations(self):
+        return [a['SubnetId'] for a in self['Associations'] if 'SubnetId' in a]
+
     def inSubnet(self, subnet=None):
         if subnet:
             for assoc in self['Associations']:
@@ -185,6 +380,18 @@ class NetworkAcl(Dot):
         fh.write("</table>>\n")
         fh.write("];\n")
 
+    def cidrs(self):
+        ans = []
+        for e in self['Entries']:
+            if 'CidrBlock' not in e:
+                continue
+            protocol = {'6': 'tcp', '17': 'udp', '-1': 'all'}.get(e['Protocol'], e['Protocol'])
+            if 'PortRange' in e:
+                protocol = "%s-%s/%s" % (e['PortRange']['From'], e['PortRange']['To'], protocol)
+            direct = 'egress' if e['Egress'] else 'ingress'
+            ans.append((e['CidrBlock'], "rule %s %s %s %s" % (e['RuleNumber'], direct, e['RuleAction'], protocol)))
+        return ans
+
     def relevent_to_ip(self, ip):
         for e in self['Entries']:
             if netaddr.IPAddress(ip) in netaddr.IPNetwork(e['CidrBlock']):
@@ -235,10 +442,9 @@ class Instance(Dot):
     u'VirtualizationType': u'paravirtual',
     u'VpcId': u'vpc-XXXXXXXX',
     """
-    def __init__(self, instance, args):
-        self.data = instance
-        self.name = instance['InstanceId']
-        self.args = args
+    __slots__ = ()
+    idkey = 'InstanceId'
+    fields = ('PrivateIpAddress', 'SecurityGroups', 'SubnetId', 'VpcId')
 
     def inSubnet(self, subnet=None):
         if subnet and self['SubnetId'] != subnet:
@@ -250,8 +456,11 @@ class Instance(Dot):
             return False
         return True
 
+    def securityGroups(self):
+        return [sg['GroupId'] for sg in self['SecurityGroups']]
+
     def rank(self, fh):
-        if self.inVpc(self.args.vpc) and self.inSubnet(self.args.subnet):
+        if self.inVpc(fh.args.vpc) and self.inSubnet(fh.args.subnet):
             fh.write("%s;" % self.mn())
 
     def drawSec(self, fh):
@@ -264,28 +473,25 @@ class Instance(Dot):
             self.connect(fh, self.name, self['SubnetId'])
 
     def draw(self, fh):
-        global clusternum
-        if not self.inVpc(self.args.vpc) or not self.inSubnet(self.args.subnet):
+        if not self.inVpc(fh.args.vpc) or not self.inSubnet(fh.args.subnet):
             return
         fh.write('// Instance %s\n' % self.name)
-        fh.write('subgraph cluster_%d {\n' % clusternum)
+        fh.write('subgraph cluster_%s {\n' % self.mn())
         if self.tags('Name'):
             fh.write('label = "%s"\n' % self.tags('Name'))
         fh.write('%s [label="%s" %s];\n' % (self.mn(self.name), self.name, self.image()))
 
         extraconns = []
-        for o in objects.values():
-            if o.partOfInstance(self.name):
-                self.connect(fh, self.name, o.name)
-                extraconns = o.subclusterDraw(fh)
+        for o in attached.get(self.key, []):
+            self.connect(fh, self.name, o.name)
+            extraconns.extend(o.subclusterDraw(fh))
         fh.write('graph [style=dotted]\n')
         fh.write('}\n')   # End subgraph cluster
         if self['SubnetId']:
             self.connect(fh, self.name, self['SubnetId'])
         for ic, ec in extraconns:
             self.connect(fh, ic, ec)
-        clusternum += 1
-        if self.args.security:
+        if fh.args.security:
             for sg in self['SecurityGroups']:
                 self.connect(fh, self.name, sg['GroupId'])
 
@@ -308,16 +514,18 @@ class Subnet(Dot):
              {u'Key': u'aws:cloudformation:logical-id', u'Value': u'SubnetA3'}],
     u'VpcId': u'vpc-XXXXXXXX',
     """
-    def __init__(self, subnet, args):
-        self.data = subnet
-        self.name = subnet['SubnetId']
-        self.args = args
+    __slots__ = ()
+    idkey = 'SubnetId'
+    fields = ('AvailabilityZone', 'CidrBlock', 'VpcId')
 
     def inVpc(self, vpc):
         if vpc and self['VpcId'] != vpc:
             return False
         return True
 
+    def cidrs(self):
+        return [(self['CidrBlock'], self['AvailabilityZone'])]
+
     def relevent_to_ip(self, ip):
         if netaddr.IPAddress(ip) in netaddr.IPNetwork(self['CidrBlock']):
             print "Subnet %s - ip %s is relevent to %s" % (self.name, ip, self['CidrBlock'])
@@ -330,7 +538,7 @@ class Subnet(Dot):
         return True
 
     def rank(self, fh):
-        if self.inVpc(self.args.vpc) and self.inSubnet(self.args.subnet):
+        if self.inVpc(fh.args.vpc) and self.inSubnet(fh.args.subnet):
             fh.write("%s;" % self.mn())
 
     def drawSec(self, fh):
@@ -339,7 +547,7 @@ class Subnet(Dot):
         self.connect(fh, self.name, self['VpcId'])
 
     def draw(self, fh):
-        if not self.inVpc(self.args.vpc) or not self.inSubnet(self.args.subnet):
+        if not self.inVpc(fh.args.vpc) or not self.inSubnet(fh.args.subnet):
             return
         fh.write('// Subnet %s\n' % self.name)
         fh.write('%s [label="%s\n%s" %s];\n' % (self.mn(self.name), self.name, self['CidrBlock'], self.image()))
@@ -363,25 +571,21 @@ class Volume(Dot):
     u'VolumeId': u'vol-XXXXXXXX',
     u'VolumeType': u'standard',
     """
-    def __init__(self, vol, args):
-        self.data = vol
-        self.name = vol['VolumeId']
-        self.args = args
+    __slots__ = ()
+    idkey = 'VolumeId'
+    fields = ('Attachments', 'Size', 'State')
 
-    def partOfInstance(self, instid):
-        for a in self['Attachments']:
-            if a['InstanceId'] == instid:
-                return True
-        return False
+    def attachedTo(self):
+        return [a['InstanceId'] for a in self['Attachments']]
 
     def drawSec(self, fh):
         return
 
     def draw(self, fh):
         if self['State'] not in ('in-use',):
-            if self.args.vpc:
+            if fh.args.vpc:
                 return
-            if self.args.subnet or self.args.vpc:
+            if fh.args.subnet or fh.args.vpc:
                 return
             fh.write('%s [label="Unattached Volume:%s\n%s Gb" %s];\n' % (self.mn(self.name), self.name, self['Size'], self.image()))
 
@@ -410,14 +614,12 @@ class SecurityGroup(Dot):
     u'Tags': [{u'Key': u'Key', u'Value': u'Value'}, ...
     u'VpcId': u'vpc-XXXXXXXX',
     """
-    def __init__(self, sg, args):
-        self.data = sg
-        self.name = sg['GroupId']
-        self.args = args
-        self.drawn = False
+    __slots__ = ()
+    idkey = 'GroupId'
+    fields = ('Description', 'IpPermissions', 'IpPermissionsEgress', 'VpcId')
 
     def draw(self, fh):
-        if self.args.vpc and self['VpcId'] != self.args.vpc:
+        if fh.args.vpc and self['VpcId'] != fh.args.vpc:
             return
 
         portstr = self.permstring(fh, self['IpPermissions'])
@@ -432,28 +634,27 @@ class SecurityGroup(Dot):
         fh.write('%s [label="SG: %s\n%s\n%s" %s];\n' % (self.mn(self.name), self.name, desc, "\n".join(tportstr), self.image()))
 
     def drawSec(self, fh):
-        global clusternum
-        self.extraRules = []
+        extraRules = []
+        cluster = fh.nextcluster()
         fh.write("// SG %s\n" % self.name)
-        fh.write('subgraph cluster_%d {\n' % clusternum)
+        fh.write('subgraph cluster_%d {\n' % cluster)
         fh.write('style=filled; color="grey90";\n')
-        fh.write('node [style=filled, color="%s"];\n' % colours[clusternum])
+        fh.write('node [style=filled, color="%s"];\n' % colours[cluster % len(colours)])
         desc = "\\n".join(chunkstring(self['Description'], 20))
         fh.write('%s [shape="rect", label="%s\n%s"]\n' % (self.mn(), self.name, desc))
         if self['IpPermissions']:
-            self.genRuleBlock(self['IpPermissions'], 'ingress', fh)
+            extraRules.extend(self.genRuleBlock(self['IpPermissions'], 'ingress', fh))
         if self['IpPermissionsEgress']:
-            self.genRuleBlock(self['IpPermissionsEgress'], 'egress', fh)
-        clusternum += 1
+            extraRules.extend(self.genRuleBlock(self['IpPermissionsEgress'], 'egress', fh))
         fh.write("}\n")
 
         if self['IpPermissions']:
             fh.write("%s_ingress_rules -> %s [weight=5];\n" % (self.mn(), self.mn()))
         if self['IpPermissionsEgress']:
             fh.write("%s -> %s_egress_rules [weight=5];\n" % (self.mn(), self.mn()))
-        for r in self.extraRules:
+        for r in extraRules:
             fh.write(r)
-        self.drawn = True
+        fh.drawn.add(self.name)
 
     def genRuleBlock(self, struct, direct, fh):
         fh.write("// SG %s %s\n" % (self.name, direct))
@@ -489,11 +690,26 @@ class SecurityGroup(Dot):
         fh.write("</table>>\n")
         fh.write("];\n")
 
+        extraRules = []
         for e in struct:
             if e['UserIdGroupPairs']:
                 for pair in e['UserIdGroupPairs']:
-                    secGrpToDraw.add(pair['GroupId'])
-                    self.extraRules.append('%s_%s_rules -> %s;\n' % (self.mn(), direct, self.mn(pair['GroupId'])))
+                    fh.secgroups.add(pair['GroupId'])
+                    extraRules.append('%s_%s_rules -> %s;\n' % (self.mn(), direct, self.mn(pair['GroupId'])))
+        return extraRules
+
+    def cidrs(self):
+        ans = []
+        for direct, perms in (('ingress', self['IpPermissions']), ('egress', self['IpPermissionsEgress'])):
+            for perm in perms:
+                if 'FromPort' in perm and perm['FromPort']:
+                    ports = "%s-%s/%s" % (perm['FromPort'], perm['ToPort'], perm['IpProtocol'])
+                else:
+                    ports = 'ALL'
+                for ipr in perm['IpRanges']:
+                    if 'CidrIp' in ipr:
+                        ans.append((ipr['CidrIp'], "%s %s" % (direct, ports)))
+        return ans
 
     def relevent_to_ip(self, ip):
         for i in self['IpPermissions']:
@@ -539,10 +755,9 @@ class VPC(Dot):
     u'State': u'available',
     u'VpcId': u'vpc-XXXXXXXX',
     """
-    def __init__(self, vpc, args):
-        self.data = vpc
-        self.name = vpc['VpcId']
-        self.args = args
+    __slots__ = ()
+    idkey = 'VpcId'
+    fields = ('CidrBlock',)
 
     def inVpc(self, vpc):
         if vpc and self.name != vpc:
@@ -553,10 +768,13 @@ class VPC(Dot):
         """ Return True if the subnet is in this VPC"""
         if not subnet:
             return True
-        if objects[subnet].inVpc(self.name):
+        if self.obj(subnet).inVpc(self.name):
             return True
         return False
 
+    def cidrs(self):
+        return [(self['CidrBlock'], '')]
+
     def relevent_to_ip(self, ip):
         if netaddr.IPAddress(ip) in netaddr.IPNetwork(self['CidrBlock']):
             print "VPC %s - ip %s is relevent to %s" % (self.name, ip, self['CidrBlock'])
@@ -564,14 +782,14 @@ class VPC(Dot):
         return False
 
     def rank(self, fh):
-        if self.inVpc(self.args.vpc) and self.inSubnet(self.args.subnet):
+        if self.inVpc(fh.args.vpc) and self.inSubnet(fh.args.subnet):
             fh.write("%s;" % self.mn())
 
     def drawSec(self, fh):
         fh.write('%s [label="%s:%s" %s];\n' % (self.mn(self.name), self.__class__.__name__, self.name, self.image()))
 
     def draw(self, fh):
-        if not self.inVpc(self.args.vpc) or not self.inSubnet(self.args.subnet):
+        if not self.inVpc(fh.args.vpc) or not self.inSubnet(fh.args.subnet):
             return
         fh.write('%s [label="%s:%s" %s];\n' % (self.mn(self.name), self.__class__.__name__, self.name, self.image()))
 
@@ -594,13 +812,12 @@ class RouteTable(Dot):
     u'VpcId': u'vpc-XXXXXXXX',
 
     """
-    def __init__(self, rt, args):
-        self.data = rt
-        self.args = args
-        self.name = self['RouteTableId']
+    __slots__ = ()
+    idkey = 'RouteTableId'
+    fields = ('Associations', 'Routes', 'VpcId')
 
     def rank(self, fh):
-        if self.inVpc(self.args.vpc) and self.inSubnet(self.args.subnet):
+        if self.inVpc(fh.args.vpc) and self.inSubnet(fh.args.subnet):
             fh.write("%s;" % self.mn())
 
     def inVpc(self, vpc):
@@ -608,6 +825,14 @@ class RouteTable(Dot):
             return False
         return True
 
+    def cidrs(self):
+        ans = []
+        for rt in self['Routes']:
+            if 'DestinationCidrBlock' not in rt:
+                continue
+            ans.append((rt['DestinationCidrBlock'], "route via %s (%s)" % (route_target(rt), rt['State'])))
+        return ans
+
     def relevent_to_ip(self, ip):
         for rt in self['Routes']:
             if netaddr.IPAddress(ip) in netaddr.IPNetwork(rt['DestinationCidrBlock']):
@@ -623,6 +848,9 @@ class RouteTable(Dot):
                 return True
         return False
 
+    def subnetAssociations(self):
+        return [a['SubnetId'] for a in self['Associations'] if 'SubnetId' in a]
+
     def drawSec(self, fh):
         routelist = []
         for rt in self['Routes']:
@@ -643,7 +871,7 @@ class RouteTable(Dot):
         fh.write("</table>>];\n")
 
     def draw(self, fh):
-        if not self.inVpc(self.args.vpc) or not self.inSubnet(self.args.subnet):
+        if not self.inVpc(fh.args.vpc) or not self.inSubnet(fh.args.subnet):
             return
         routelist = []
         for rt in self['Routes']:
@@ -652,11 +880,11 @@ class RouteTable(Dot):
         fh.write('%s [label="RT: %s\n%s" %s];\n' % (self.mn(), self.name, ";".join(routelist), self.image()))
         for ass in self['Associations']:
             if 'SubnetId' in ass:
-                if objects[ass['SubnetId']].inSubnet(self.args.subnet):
+                if self.obj(ass['SubnetId']).inSubnet(fh.args.subnet):
                     self.connect(fh, self.name, ass['SubnetId'])
         for rt in self['Routes']:
             if 'InstanceId' in rt:
-                if objects[rt['InstanceId']].inSubnet(self.args.subnet):
+                if self.obj(rt['InstanceId']).inSubnet(fh.args.subnet):
                     self.connect(fh, self.name, rt['InstanceId'])
             elif 'NetworkInterfaceId' in rt:
                 self.connect(fh, self.name, rt['NetworkInterfaceId'])
@@ -692,16 +920,18 @@ class NetworkInterface(Dot):
     u'TagSet': [],
     u'VpcId': u'vpc-XXXXXXXX',
     """
-    def __init__(self, nic, args):
-        self.data = nic
-        self.args = args
-        self.name = self['NetworkInterfaceId']
+    __slots__ = ()
+    idkey = 'NetworkInterfaceId'
+    fields = ('Attachment', 'Groups', 'PrivateIpAddress', 'SubnetId', 'VpcId')
 
-    def partOfInstance(self, instid):
+    def attachedTo(self):
         try:
-            return self['Attachment'].get('InstanceId', None) == instid
-        except AttributeError:
-            return False
+            return [self['Attachment']['InstanceId']]
+        except (TypeError, KeyError):
+            return []
+
+    def securityGroups(self):
+        return [g['GroupId'] for g in self['Groups']]
 
     def inSubnet(self, subnet=None):
         if subnet and self['SubnetId'] != subnet:
@@ -714,7 +944,7 @@ class NetworkInterface(Dot):
     def subclusterDraw(self, fh):
         fh.write('%s [label="NIC: %s\n%s" %s];\n' % (self.mn(self.name), self.name, self['PrivateIpAddress'], self.image()))
         externallinks = []
-        if self.args.security:
+        if fh.args.security:
             for g in self['Groups']:
                 externallinks.append((self.name, g['GroupId']))
         return externallinks
@@ -732,34 +962,43 @@ class InternetGateway(Dot):
         {u'Key': u'aws:cloudformation:logical-id', u'Value': u'InternetGateway'},
         {u'Key': u'aws:cloudformation:stack-name', u'Value': u'Stuff'}],
     """
+    __slots__ = ('conns',)
+    idkey = 'InternetGatewayId'
+
     def __init__(self, igw, args):
-        self.data = igw
-        self.name = igw['InternetGatewayId']
+        Dot.__init__(self, igw, args)
         self.conns = []
         for i in igw['Attachments']:
             self.conns.append(i['VpcId'])
-        self.args = args
+
+    def vpcIds(self):
+        return self.conns
+
+    def data(self):
+        data = Dot.data(self)
+        data['Attachments'] = [{'VpcId': x} for x in self.conns]
+        return data
+
+    def visibleConns(self, args):
+        """ The VPCs this is attached to that are being drawn """
+        conns = []
+        for i in self.conns:
+            if args.vpc and i != args.vpc:
+                continue
+            if args.subnet and not self.obj(i).inSubnet(args.subnet):
+                continue
+            conns.append(i)
+        return conns
 
     def rank(self, fh):
-        if self.args.vpc:
-            for i in self.conns[:]:
-                if i != self.args.vpc:
-                    self.conns.remove(i)
-        if self.conns:
+        if self.visibleConns(fh.args):
             fh.write("%s;" % self.mn())
 
     def draw(self, fh):
-        if self.args.vpc:
-            for i in self.conns[:]:
-                if i != self.args.vpc:
-                    self.conns.remove(i)
-        if self.args.subnet:
-            for i in self.conns[:]:
-                if not objects[i].inSubnet(self.args.subnet):
-                    self.conns.remove(i)
-        if self.conns:
+        conns = self.visibleConns(fh.args)
+        if conns:
             fh.write('%s [label="InternetGateway: %s" %s];\n' % (self.mn(self.name), self.name, self.image()))
-            for i in self.conns:
+            for i in conns:
                 self.connect(fh, self.name, i)
 
 
@@ -792,10 +1031,9 @@ class LoadBalancer(Dot):
     u'Subnets': [u'subnet-XXXXXXXX', u'subnet-XXXXXXXX'],
     u'VPCId': u'vpc-XXXXXXXX',
     """
-    def __init__(self, lb, args):
-        self.data = lb
-        self.name = lb[u'LoadBalancerName']
-        self.args = args
+    __slots__ = ()
+    idkey = 'LoadBalancerName'
+    fields = ('Instances', 'ListenerDescriptions', 'SecurityGroups', 'Subnets', 'VPCId')
 
     def inSubnet(self, subnet=None):
         if subnet and subnet not in self['Subnets']:
@@ -807,12 +1045,21 @@ class LoadBalancer(Dot):
             return False
         return True
 
+    def securityGroups(self):
+        return self['SecurityGroups']
+
+    def vpcIds(self):
+        return [self['VPCId']]
+
+    def subnetIds(self):
+        return self['Subnets']
+
     def rank(self, fh):
-        if self.inVpc(self.args.vpc) and self.inSubnet(self.args.subnet):
+        if self.inVpc(fh.args.vpc) and self.inSubnet(fh.args.subnet):
             fh.write("%s;" % self.mn())
 
     def draw(self, fh):
-        if not self.inVpc(self.args.vpc) or not self.inSubnet(self.args.subnet):
+        if not self.inVpc(fh.args.vpc) or not self.inSubnet(fh.args.subnet):
             return
         ports = []
         for l in self['ListenerDescriptions']:
@@ -821,14 +1068,14 @@ class LoadBalancer(Dot):
 
         fh.write('%s [label="ELB: %s\n%s" %s];\n' % (self.mn(self.name), self.name, "\n".join(ports), self.image()))
         for i in self['Instances']:
-            if objects[i['InstanceId']].inSubnet(self.args.subnet):
+            if self.obj(i['InstanceId']).inSubnet(fh.args.subnet):
                 self.connect(fh, self.name, i['InstanceId'])
         for s in self['Subnets']:
-            if self.args.subnet:
-                if s != self.args.subnet:
+            if fh.args.subnet:
+                if s != fh.args.subnet:
                     continue
             self.connect(fh, self.name, s)
-        if self.args.security:
+        if fh.args.security:
             for sg in self['SecurityGroups']:
                 self.connect(fh, self.name, sg)
 
@@ -877,10 +1124,9 @@ class Database(Dot):
     u'ReadReplicaDBInstanceIdentifiers': [],
     u'VpcSecurityGroups': [{u'Status': u'active', u'VpcSecurityGroupId': u'sg-XXXXXXXX'}],
     """
-    def __init__(self, db, args):
-        self.data = db
-        self.name = db['DBInstanceIdentifier']
-        self.args = args
+    __slots__ = ()
+    idkey = 'DBInstanceIdentifier'
+    fields = ('DBSubnetGroup', 'Engine', 'VpcSecurityGroups')
 
     def inSubnet(self, subnet=None):
         if not subnet:
@@ -895,8 +1141,17 @@ class Database(Dot):
             return False
         return True
 
+    def securityGroups(self):
+        return [sg['VpcSecurityGroupId'] for sg in self['VpcSecurityGroups']]
+
+    def vpcIds(self):
+        return [self['DBSubnetGroup']['VpcId']]
+
+    def subnetIds(self):
+        return [s['SubnetIdentifier'] for s in self['DBSubnetGroup']['Subnets']]
+
     def rank(self, fh):
-        if self.inVpc(self.args.vpc) and self.inSubnet(self.args.subnet):
+        if self.inVpc(fh.args.vpc) and self.inSubnet(fh.args.subnet):
             fh.write("%s;" % self.mn())
 
     def drawSec(self, fh):
@@ -904,25 +1159,607 @@ class Database(Dot):
         fh.write('%s [label="DB: %s\n%s" %s];\n' % (self.mn(self.name), self.name, self['Engine'], imgstr))
 
     def draw(self, fh):
-        if not self.inVpc(self.args.vpc) or not self.inSubnet(self.args.subnet):
+        if not self.inVpc(fh.args.vpc) or not self.inSubnet(fh.args.subnet):
             return
         fh.write('// Database %s\n' % self.name)
         imgstr = self.image(["Database-%s" % self['Engine'], 'Database'])
         fh.write('%s [label="DB: %s\n%s" %s];\n' % (self.mn(self.name), self.name, self['Engine'], imgstr))
         for subnet in self['DBSubnetGroup']['Subnets']:
             if subnet['SubnetStatus'] == 'Active':
-                if objects[subnet['SubnetIdentifier']].inSubnet(self.args.subnet):
+                if self.obj(subnet['SubnetIdentifier']).inSubnet(fh.args.subnet):
                     self.connect(fh, self.name, subnet['SubnetIdentifier'])
-        if self.args.security:
+        if fh.args.security:
             for sg in self['VpcSecurityGroups']:
                 self.connect(fh, self.name, sg['VpcSecurityGroupId'])
 
 
+###############################################################################
+###############################################################################
+###############################################################################
+class CidrIndex(object):
+    """ All the cidrs in the objects, bucketed by prefix length so finding
+    everything that covers an address is a handful of dict lookups """
+    def __init__(self, objs):
+        self.prefixes = {}
+        for obj in objs:
+            for cidr, desc in obj.cidrs():
+                try:
+                    net, plen = cidr2int(cidr)
+                except ValueError:      # Not IPv4
+                    continue
+                self.prefixes.setdefault(plen, {}).setdefault(net, []).append((obj, cidr, desc))
+        self.masks = [(plen, prefixmask(plen)) for plen in sorted(self.prefixes, reverse=True)]
+
+    def lookup(self, ip):
+        """ Return the (obj, cidr, description) of everything that covers ip
+        most specific first """
+        if not isinstance(ip, (int, long)):
+            ip = ip2int(ip)
+        ans = []
+        for plen, mask in self.masks:
+            ans.extend(self.prefixes[plen].get(ip & mask, []))
+        return ans
+
+
+###############################################################################
+###############################################################################
+###############################################################################
+class CidrArrays(object):
+    """ The cidrs of one type of object as sorted arrays of networks per
+    prefix length - so a whole batch of addresses can be matched at once """
+    def __init__(self, objs):
+        self.objs = objs
+        byplen = {}
+        for num, obj in enumerate(objs):
+            for cidr, desc in obj.cidrs():
+                try:
+                    net, plen = cidr2int(cidr)
+                except ValueError:
+                    continue
+                byplen.setdefault(plen, []).append((net, num, cidr))
+        labels = []
+        self.prefixes = []
+        for plen in sorted(byplen, reverse=True):
+            entries = sorted(byplen[plen])
+            nets = numpy.array([e[0] for e in entries], dtype=numpy.uint32)
+            self.prefixes.append((numpy.uint32(prefixmask(plen)), nets, len(labels)))
+            labels.extend(["%s:%s" % (objs[num].key, cidr) for net, num, cidr in entries])
+        labels.append('-')
+        self.labels = numpy.array(labels, dtype=object)
+
+    def classify(self, ips):
+        """ Return the most specific "key:cidr" covering each of ips
+        (an array of uint32) or "-" """
+        miss = len(self.labels) - 1
+        found = numpy.full(len(ips), miss, dtype=numpy.int64)
+        for mask, nets, offset in self.prefixes:
+            masked = ips & mask
+            pos = numpy.searchsorted(nets, masked)
+            pos[pos == len(nets)] = 0
+            hit = (found == miss) & (nets[pos] == masked)
+            found[hit] = pos[hit] + offset
+        return self.labels[found]
+
+
+###############################################################################
+def ip2int(ip):
+    try:
+        return struct.unpack('!I', socket.inet_aton(ip))[0]
+    except (socket.error, TypeError):
+        raise ValueError("Bad IPv4 address %s" % ip)
+
+
+###############################################################################
+def prefixmask(plen):
+    return (0xffffffff << (32 - plen)) & 0xffffffff
+
+
+###############################################################################
+def cidr2int(cidr):
+    """ Convert a cidr into its network address and prefix length """
+    if '/' in cidr:
+        addr, plen = cidr.split('/')
+        plen = int(plen)
+    else:
+        addr, plen = cidr, 32
+    if not 0 <= plen <= 32 or ':' in addr:
+        raise ValueError("Bad IPv4 cidr %s" % cidr)
+    return ip2int(addr) & prefixmask(plen), plen
+
+
+###############################################################################
+def query_ip(fh, ips):
+    """ Report everything that covers each of the ips """
+    index = CidrIndex(sorted(objects.values(), key=lambda o: o.sortkey))
+    for ip in ips:
+        try:
+            matches = index.lookup(ip)
+        except ValueError as exc:
+            sys.stderr.write("%s\n" % exc)
+            continue
+        for obj, cidr, desc in matches:
+            fh.write("%s %s %s %s %s\n" % (ip, obj.__class__.__name__, obj.key, cidr, desc))
+
+
+###############################################################################
+def classify_ips(fh, infh, batchsize=65536):
+    """ Stream out the most specific subnet, vpc and route covering each
+    ip read from infh - done in batches with numpy if it is available """
+    classes = (Subnet, VPC, RouteTable)
+    if numpy:
+        arrays = [CidrArrays(bytype.get(cls, [])) for cls in classes]
+    else:
+        index = CidrIndex(sorted(objects.values(), key=lambda o: o.sortkey))
+    while True:
+        lines = list(itertools.islice(infh, batchsize))
+        if not lines:
+            break
+        ips, packed = [], []
+        for line in lines:
+            ip = line.strip()
+            if not ip:
+                continue
+            try:
+                packed.append(socket.inet_aton(ip))
+            except socket.error:
+                packed.append(None)
+            ips.append(ip)
+        good = [n for n, p in enumerate(packed) if p is not None]
+        if numpy:
+            nums = numpy.frombuffer("".join([packed[n] for n in good]), dtype='>u4').astype(numpy.uint32)
+            columns = [a.classify(nums) for a in arrays]
+        else:
+            columns = [['-'] * len(good) for cls in classes]
+            for row, n in enumerate(good):
+                for obj, cidr, desc in index.lookup(ip2int(ips[n])):
+                    if obj.__class__ in classes:
+                        col = columns[classes.index(obj.__class__)]
+                        if col[row] == '-':
+                            col[row] = "%s:%s" % (obj.key, cidr)
+        out = ["%s invalid\n" % ip for ip in ips]
+        for row, n in enumerate(good):
+            out[n] = "%s %s %s %s\n" % (ips[n], columns[0][row], columns[1][row], columns[2][row])
+        fh.write("".join(out))
+
+
+###############################################################################
+protocols = {'icmp': 1, 'tcp': 6, 'udp': 17}
+
+
+###############################################################################
+def protonum(proto):
+    """ The ip protocol number of a protocol name or number - -1 for all """
+    proto = str(proto).lower()
+    if proto == 'all':
+        return -1
+    if proto in protocols:
+        return protocols[proto]
+    return int(proto)
+
+
+###############################################################################
+###############################################################################
+###############################################################################
+class RuleTable(object):
+    """ One direction of the rules of a security group, indexed by the
+    groups and the cidr prefixes they allow traffic to or from """
+    def __init__(self, sg, direct, perms):
+        self.groups = {}        # group key -> [(protocol, from port, to port, rule)]
+        self.prefixes = {}      # prefix length -> network -> [(protocol, from port, to port, rule)]
+        for perm in perms:
+            proto = protonum(perm['IpProtocol'])
+            lo, hi = perm.get('FromPort'), perm.get('ToPort')
+            if proto == -1 or lo is None or lo == -1:
+                lo, hi, ports = 0, 65535, 'ALL'
+            else:
+                ports = "%s-%s/%s" % (lo, hi, perm['IpProtocol'])
+            for pair in perm['UserIdGroupPairs']:
+                rule = "%s:%s:%s:%s" % (sg.name, direct, ports, pair['GroupId'])
+                self.groups.setdefault(scopedkey(sg.scope, pair['GroupId']), []).append((proto, lo, hi, rule))
+            for ipr in perm['IpRanges']:
+                try:
+                    net, plen = cidr2int(ipr.get('CidrIp', ''))
+                except ValueError:
+                    continue
+                rule = "%s:%s:%s:%s" % (sg.name, direct, ports, ipr['CidrIp'])
+                self.prefixes.setdefault(plen, {}).setdefault(net, []).append((proto, lo, hi, rule))
+        self.masks = [(plen, prefixmask(plen)) for plen in sorted(self.prefixes, reverse=True)]
+
+    def allows(self, proto, port, ips, groups):
+        """ The first rule allowing proto/port to or from something with
+        these ips (as ints) and in these groups - None if there isn't one.
+        Without any ips only rules for everywhere (0.0.0.0/0) can match """
+        candidates = []
+        for group in groups:
+            candidates.extend(self.groups.get(group, []))
+        for plen, mask in self.masks:
+            for ip in ips or [0]:
+                if ips or plen == 0:
+                    candidates.extend(self.prefixes[plen].get(ip & mask, []))
+        for rproto, lo, hi, rule in candidates:
+            if rproto == -1 or (rproto == proto and lo <= port <= hi):
+                return rule
+        return None
+
+
+###############################################################################
+###############################################################################
+###############################################################################
+class Reachability(object):
+    """ Every security group compiled into rule tables along with what is
+    in them, to answer whether one thing can talk to another on a port """
+    endpoints = ('Instance', 'NetworkInterface', 'LoadBalancer', 'Database')
+
+    def __init__(self):
+        self.tables = {}        # (group key, direction) -> RuleTable
+        for sg in bytype.get(SecurityGroup, []):
+            self.tables[(sg.key, 'egress')] = RuleTable(sg, 'egress', sg['IpPermissionsEgress'] or [])
+            self.tables[(sg.key, 'ingress')] = RuleTable(sg, 'ingress', sg['IpPermissions'] or [])
+        self.members = []       # Everything that can be in a security group
+        self.named = {}         # id -> objects with it, from any profile/region
+        self.byip = {}          # ip -> members with it
+        for obj in sorted(objects.values(), key=lambda o: o.sortkey):
+            self.named.setdefault(obj.name, []).append(obj)
+            if obj.__class__.__name__ not in self.endpoints:
+                continue
+            if [i for i in obj.attachedTo() if scopedkey(obj.scope, i) in objects]:
+                continue        # The interfaces of instances are checked as the instance
+            self.members.append(obj)
+            for ip in obj.addresses():
+                self.byip.setdefault(ip, []).append(obj)
+        self.memberkeys = set([o.key for o in self.members])
+
+    def resolve(self, name):
+        """ The (label, ips, group keys) of everything name refers to - an
+        object or ip, or a security group, subnet or vpc for all that is in it """
+        found = [objects[name]] if name in objects else self.named.get(name, [])
+        if not found and name not in self.byip:
+            return [(name, [ip2int(name)], [])]     # Somewhere outside
+        objs = list(self.byip.get(name, []))
+        for obj in found:
+            if obj.__class__.__name__ in self.endpoints:
+                objs.append(obj)
+            elif isinstance(obj, SecurityGroup):
+                objs.extend([o for o in sgmembers.get(obj.key, []) if o.key in self.memberkeys])
+            elif isinstance(obj, VPC):
+                objs.extend([o for o in self.members if o.scope == obj.scope and obj.name in o.vpcIds()])
+            elif isinstance(obj, Subnet):
+                objs.extend([o for o in self.members if o.scope == obj.scope and obj.name in o.subnetIds()])
+            else:
+                raise ValueError("%s can't be in a security group" % name)
+        ans = []
+        for obj in objs:
+            ips = [ip2int(ip) for ip in obj.addresses()]
+            ans.append((obj.key, ips, [scopedkey(obj.scope, g) for g in obj.securityGroups()]))
+        return ans
+
+    def rule(self, direct, groups, proto, port, peer):
+        """ The first rule of any of the groups that allows proto/port in
+        direct from or to peer - 'none' if nothing does """
+        label, ips, peergroups = peer
+        for group in groups:
+            table = self.tables.get((group, direct))
+            if table is not None:
+                rule = table.allows(proto, port, ips, peergroups)
+                if rule is not None:
+                    return rule
+        return 'none'
+
+    def check(self, src, dst, proto, port):
+        """ Return whether src can talk to dst, with the egress and ingress
+        rules that let it (or 'none') - ips outside are 'external' """
+        egress = ingress = 'external'
+        if src[2]:
+            egress = self.rule('egress', src[2], proto, port, dst)
+        if dst[2]:
+            ingress = self.rule('ingress', dst[2], proto, port, src)
+        return 'none' not in (egress, ingress), egress, ingress
+
+
+###############################################################################
+def query_reach(fh, infh):
+    """ Report whether each 'source destination port[/protocol]' read from
+    infh is allowed by the security groups - every pair of what is in them
+    if the source or destination is a group, subnet or vpc """
+    reach = Reachability()
+    for line in infh:
+        words = line.split()
+        if not words or words[0].startswith('#'):
+            continue
+        try:
+            if len(words) != 3:
+                raise ValueError("expected 'source destination port[/protocol]'")
+            srcname, dstname, port = words
+            port, _, protoname = port.partition('/')
+            protoname = protoname or 'tcp'
+            proto, port = protonum(protoname), int(port)
+            srcs, dsts = reach.resolve(srcname), reach.resolve(dstname)
+        except ValueError as exc:
+            sys.stderr.write("Can't check %s: %s\n" % (line.strip(), exc))
+            continue
+        for src in srcs:
+            for dst in dsts:
+                if src[0] == dst[0] or not (src[2] or dst[2]):
+                    continue
+                allowed, egress, ingress = reach.check(src, dst, proto, port)
+                fh.write("%s %s %s/%s %s %s %s\n" % (
+                    src[0], dst[0], port, protoname, 'allow' if allowed else 'deny', egress, ingress))
+
+
+###############################################################################
+###############################################################################
+###############################################################################
+class AclTable(object):
+    """ One direction of the entries of a network acl, bucketed by prefix
+    length and network with each bucket in rule number order """
+    def __init__(self, acl, egress):
+        self.prefixes = {}      # prefix length -> network -> [(rule number, protocol, from port, to port, verdict)]
+        direct = 'egress' if egress else 'ingress'
+        for e in sorted(acl['Entries'] or [], key=lambda e: e['RuleNumber']):
+            if e['Egress'] != egress:
+                continue
+            try:
+                net, plen = cidr2int(e.get('CidrBlock', ''))
+            except ValueError:      # IPv6
+                continue
+            proto = protonum(e['Protocol'])
+            lo, hi = 0, 65535
+            if 'PortRange' in e and proto != -1:
+                lo, hi = e['PortRange']['From'], e['PortRange']['To']
+            verdict = "%s:%s:%s:%s" % (acl.name, direct, e['RuleNumber'], e['RuleAction'])
+            self.prefixes.setdefault(plen, {}).setdefault(net, []).append((e['RuleNumber'], proto, lo, hi, verdict))
+        self.masks = [(plen, prefixmask(plen)) for plen in sorted(self.prefixes)]
+
+    def evaluate(self, ip, proto, port):
+        """ The lowest numbered entry matching traffic to or from ip (an
+        int) - None if nothing does, which means it is denied """
+        best = None
+        for plen, mask in self.masks:
+            for entry in self.prefixes[plen].get(ip & mask, ()):
+                if best is not None and entry[0] >= best[0]:
+                    break
+                if entry[1] == -1 or (entry[1] == proto and entry[2] <= port <= entry[3]):
+                    best = entry
+                    break
+        return best
+
+
+###############################################################################
+###############################################################################
+###############################################################################
+class AclEvaluator(object):
+    """ The network acls of every subnet compiled into AclTables, to say
+    whether traffic between two addresses gets through them """
+    def __init__(self):
+        self.subnets = CidrIndex(bytype.get(Subnet, []))
+        self.tables = {}        # subnet key -> (egress table, ingress table)
+        for acl in bytype.get(NetworkAcl, []):
+            tables = (AclTable(acl, True), AclTable(acl, False))
+            for subnet in acl.subnetAssociations():
+                self.tables[scopedkey(acl.scope, subnet)] = tables
+
+    def subnet(self, ip):
+        """ The key of the most specific subnet with ip in it, or None """
+        for obj, cidr, desc in self.subnets.lookup(ip):
+            return obj.key
+        return None
+
+    def verdict(self, subnet, index, ip, proto, port):
+        if subnet not in self.tables:
+            return 'none'
+        entry = self.tables[subnet][index].evaluate(ip, proto, port)
+        if entry is None:
+            return 'none'
+        return entry[4]
+
+    def check(self, src, dst, proto, port, srcsubnet, dstsubnet):
+        """ Return whether traffic from src to dst (ints in the subnets
+        given) is allowed, with the egress and ingress entries that decided
+        it - 'external' for ips outside the subnets, and 'local' for both
+        if they are in the same subnet as then the acls don't apply """
+        if srcsubnet is not None and srcsubnet == dstsubnet:
+            return True, 'local', 'local'
+        egress = ingress = 'external'
+        if srcsubnet is not None:
+            egress = self.verdict(srcsubnet, 0, dst, proto, port)
+        if dstsubnet is not None:
+            ingress = self.verdict(dstsubnet, 1, src, proto, port)
+        allowed = not [v for v in (egress, ingress) if v == 'none' or v.endswith(':deny')]
+        return allowed, egress, ingress
+
+
+###############################################################################
+def parse_flow(words):
+    """ The (src, dst, port, protocol name) of a 'source destination
+    port[/protocol]' query or a default format vpc flow log record """
+    if len(words) == 3:
+        port, _, protoname = words[2].partition('/')
+        return words[0], words[1], int(port), protoname or 'tcp'
+    if len(words) == 14:
+        return words[3], words[4], int(words[6]), words[7]
+    raise ValueError("expected 'source destination port[/protocol]' or a flow log record")
+
+
+###############################################################################
+def query_nacls(fh, infh, batchsize=65536):
+    """ Report whether the network acls let through each flow read from
+    infh - done in batches, looking up the subnet of each ip once a batch """
+    acls = AclEvaluator()
+    while True:
+        lines = list(itertools.islice(infh, batchsize))
+        if not lines:
+            break
+        subnets = {}        # ip -> (int, subnet key)
+        out = []
+        for line in lines:
+            words = line.split()
+            if not words or words[0].startswith('#') or words[0] == 'version' or '-' in words[3:8]:
+                continue        # Blank, comment, header or NODATA flow log records
+            try:
+                src, dst, port, protoname = parse_flow(words)
+                for ip in (src, dst):
+                    if ip not in subnets:
+                        num = ip2int(ip)
+                        subnets[ip] = (num, acls.subnet(num))
+                proto = protonum(protoname)
+            except ValueError as exc:
+                sys.stderr.write("Can't check %s: %s\n" % (line.strip(), exc))
+                continue
+            allowed, egress, ingress = acls.check(subnets[src][0], subnets[dst][0], proto, port, subnets[src][1], subnets[dst][1])
+            out.append("%s %s %s/%s %s %s %s\n" % (
+                src, dst, port, protoname, 'allow' if allowed else 'deny', egress, ingress))
+        fh.write("".join(out))
+
+
+###############################################################################
+routeTargets = ('GatewayId', 'NatGatewayId', 'TransitGatewayId', 'VpcPeeringConnectionId', 'InstanceId', 'NetworkInterfaceId')
+routeKinds = {
+    'igw': 'internet-gateway', 'eigw': 'egress-only-gateway', 'vgw': 'vpn-gateway', 'nat': 'nat-gateway',
+    'tgw': 'transit-gateway', 'pcx': 'peering', 'i': 'instance', 'eni': 'interface'}
+
+
+###############################################################################
+def route_target(route):
+    """ The id of where a route sends traffic """
+    for field in routeTargets:
+        if route.get(field):
+            return route[field]
+    return None
+
+
+###############################################################################
+###############################################################################
+###############################################################################
+class RouteLookup(object):
+    """ The routes of a route table bucketed by prefix length and network
+    so the longest prefix matching an address is a handful of dict lookups """
+    def __init__(self, rtable):
+        self.prefixes = {}      # prefix length -> network -> route
+        for route in rtable['Routes'] or []:
+            try:
+                net, plen = cidr2int(route.get('DestinationCidrBlock', ''))
+            except ValueError:      # IPv6 or a prefix list
+                continue
+            self.prefixes.setdefault(plen, {})[net] = route
+        self.masks = [(plen, prefixmask(plen)) for plen in sorted(self.prefixes, reverse=True)]
+
+    def lookup(self, ip):
+        """ The most specific route covering ip (an int) or None """
+        for plen, mask in self.masks:
+            route = self.prefixes[plen].get(ip & mask)
+            if route is not None:
+                return route
+        return None
+
+
+###############################################################################
+###############################################################################
+###############################################################################
+class Router(object):
+    """ The route table each subnet uses - the one it is associated with,
+    otherwise the main one of its vpc - to say where traffic goes """
+    def __init__(self):
+        self.subnets = CidrIndex(bytype.get(Subnet, []))
+        self.lookups = {}       # route table key -> RouteLookup
+        self.tables = {}        # subnet key, or vpc key for the main table -> route table
+        for rtable in bytype.get(RouteTable, []):
+            self.lookups[rtable.key] = RouteLookup(rtable)
+            for assoc in rtable['Associations'] or []:
+                if assoc.get('Main'):
+                    self.tables[scopedkey(rtable.scope, rtable['VpcId'])] = rtable
+            for subnet in rtable.subnetAssociations():
+                self.tables[scopedkey(rtable.scope, subnet)] = rtable
+
+    def subnet(self, source):
+        """ The subnet of a subnet id, something in a subnet or an ip """
+        obj = objects.get(source)
+        if obj is None:
+            for obj, cidr, desc in self.subnets.lookup(source):
+                if isinstance(obj, Subnet):
+                    return obj
+            raise ValueError("%s isn't in any subnet" % source)
+        if isinstance(obj, Subnet):
+            return obj
+        if obj['SubnetId']:
+            return obj.obj(obj['SubnetId'])
+        raise ValueError("%s isn't in a subnet" % source)
+
+    def table(self, subnet):
+        """ The route table used by a subnet, None if there isn't one """
+        return self.tables.get(subnet.key) or self.tables.get(scopedkey(subnet.scope, subnet['VpcId']))
+
+    def resolve(self, subnet, ip):
+        """ Return the route table, route and (target, kind) of where
+        traffic from a subnet to ip (an int) goes """
+        rtable = self.table(subnet)
+        if rtable is None:
+            return None, None, ('-', 'none')
+        route = self.lookups[rtable.key].lookup(ip)
+        if route is None:
+            return rtable, None, ('-', 'none')
+        target = route_target(route)
+        if route.get('State') == 'blackhole':
+            return rtable, route, (target, 'blackhole')
+        if target == 'local':
+            return rtable, route, (target, 'local')
+        return rtable, route, (target, routeKinds.get(str(target).split('-')[0], 'other'))
+
+
+###############################################################################
+def query_routes(fh, infh, batchsize=65536):
+    """ Report where the traffic of each 'source destination' read from
+    infh goes - the source being a subnet, something in one or an ip """
+    router = Router()
+    while True:
+        lines = list(itertools.islice(infh, batchsize))
+        if not lines:
+            break
+        subnets = {}        # source -> subnet
+        out = []
+        for line in lines:
+            words = line.split()
+            if not words or words[0].startswith('#'):
+                continue
+            try:
+                if len(words) != 2:
+                    raise ValueError("expected 'source destination'")
+                source, dest = words
+                if source not in subnets:
+                    subnets[source] = router.subnet(source)
+                rtable, route, (target, kind) = router.resolve(subnets[source], ip2int(dest))
+            except ValueError as exc:
+                sys.stderr.write("Can't route %s: %s\n" % (line.strip(), exc))
+                continue
+            out.append("%s %s %s %s %s %s %s\n" % (
+                source, dest, subnets[source].key, rtable.key if rtable else '-',
+                route['DestinationCidrBlock'] if route else '-', target, kind))
+        fh.write("".join(out))
+
+
 ###############################################################################
 def header(lbl):
     return '<td bgcolor="black"><font color="white">%s</font></td>' % lbl
 
 
+###############################################################################
+def munge(s, scope=''):
+    """ Munge name to be dottable """
+    s = s.replace('-', '_')
+    s = s.replace("'", '"')
+    if scope:
+        s = "%s__%s" % (re.sub(r'\W', '_', scope), s)
+    return s
+
+
+###############################################################################
+def scopedkey(scope, name):
+    """ Objects from different profiles/regions can share ids so prefix them
+    with where they came from in the objects registry """
+    if scope:
+        return "%s/%s" % (scope, name)
+    return name
+
+
 ###############################################################################
 def chunkstring(strng, length):
     """ Break a string on word boundaries, where each line is up to
@@ -960,181 +1797,969 @@ def ec2cmd(cmd):
 
 
 ###############################################################################
-def awscmd(cmd, area='ec2'):
-    cachepath = '.cache'
-    if not os.path.exists(cachepath):
-        os.mkdir(cachepath)
-    fullcmd = 'aws %s %s %s' % (" ".join(awsflags), area, cmd)
-    cachefile = os.path.join(cachepath, md5.md5(fullcmd).hexdigest())
-
-    if not nocache and os.path.exists(cachefile):
+def awscmd(cmd, area='ec2', ttl=None, refresh=False, usecache=True):
+    """ Run an aws command, using the cached output if it is younger than
+    ttl seconds (forever if no ttl) unless we were asked to refresh it """
+    fullcmd, cachefile = cachename(cmd, area)
+    start = time.time()
+
+    hit = usecache and not nocache and not refresh and cache_fresh(cachefile, ttl)
+    if hit:
         with open(cachefile) as f:
             data = f.read()
     else:
-        with os.popen(fullcmd) as f:
-            data = f.read()
-            with open(cachefile, 'w') as g:
-                g.write(data)
+        data = awsoutput(fullcmd)
 
+    fetched = time.time()
     try:
-        return json.loads(data)
+        ans = json.loads(data)
     except ValueError:
         sys.stderr.write("Failed to decode output from %s\n%s\n" % (fullcmd, data))
         sys.exit(1)
+    if usecache and not hit:    # Only once we know it isn't an error
+        cache_write(cachefile, fullcmd, data)
+    if profiling is not None:
+        profiling['commands'].append({
+            'command': fullcmd, 'cache': 'hit' if hit else 'miss', 'bytes': len(data),
+            'fetch_seconds': fetched - start, 'json_seconds': time.time() - fetched})
+    return ans
 
 
 ###############################################################################
-def get_all_internet_gateways(args):
-    if args.verbose:
-        sys.stderr.write("Getting internet gateways\n")
-    igw_data = ec2cmd("describe-internet-gateways")['InternetGateways']
-    for igw in igw_data:
-        g = InternetGateway(igw, args)
-        objects[g.name] = g
+def awsoutput(fullcmd):
+    """ Return the json output of an aws command line from whichever backend
+    we are using """
+    if backend == 'api':
+        return json.dumps(apicall(fullcmd), indent=4, default=lambda x: x.isoformat())
+    with os.popen(fullcmd) as f:
+        return f.read()
 
 
 ###############################################################################
-def get_vpc_list(args):
-    vpc_data = ec2cmd("describe-vpcs")['Vpcs']
-    for vpc in vpc_data:
-        if args.vpc and vpc['VpcId'] != args.vpc:
+def apiclient(service, profile=None, region=None, endpoint=None, verify=True, signed=True):
+    """ Return the boto3 client for a service, creating it the first time
+    so all the calls to it share the one connection pool. Clients aren't
+    shared across a fork """
+    key = (os.getpid(), service, profile, region, endpoint, verify, signed)
+    with apilock:       # Sessions aren't thread safe
+        if key not in apiclients:
+            session = boto3.session.Session(profile_name=profile, region_name=region)
+            config = None
+            if not signed:
+                config = botocore.config.Config(signature_version=botocore.UNSIGNED)
+            apiclients[key] = session.client(service, endpoint_url=endpoint, verify=verify, config=config)
+        return apiclients[key]
+
+
+###############################################################################
+def apicall(fullcmd):
+    """ Make the api call that an aws command line would in process, and
+    return the same data the cli would have output """
+    words, opts, values = [], {}, None
+    for word in shlex.split(fullcmd)[1:]:
+        if word.startswith('--'):
+            opt, _, val = word[2:].partition('=')
+            values = opts.setdefault(opt, [])
+            if val:
+                values.append(val)
+            if opt in cliSwitches:
+                values = None
+        elif values is not None and (len(words) == 2 or not values):
+            values.append(word)     # Options before the service only take one value
+        else:
+            words.append(word)
+            values = None
+    service, method = words[0], words[1].replace('-', '_')
+    query = opts.pop('query', [None])[0]
+    paginate = opts.pop('no-paginate', None) is None
+    if opts.pop('debug', None) is not None:
+        boto3.set_stream_logger('botocore')
+    for opt in ('no-cli-pager', 'cli-auto-prompt', 'no-cli-auto-prompt'):
+        opts.pop(opt, None)     # Only matter to the cli itself
+    client = apiclient(
+        service, opts.pop('profile', [None])[0], opts.pop('region', [None])[0], opts.pop('endpoint-url', [None])[0],
+        opts.pop('no-verify-ssl', None) is None, opts.pop('no-sign-request', None) is None)
+
+    model = client.meta.service_model.operation_model(client.meta.method_to_api_mapping[method])
+    members = {}
+    if model.input_shape is not None:
+        members = dict((botocore.xform_name(m, '-'), (m, shape)) for m, shape in model.input_shape.members.items())
+    params, paging = {}, {}
+    for opt, member in (('max-items', 'MaxItems'), ('page-size', 'PageSize'), ('starting-token', 'StartingToken')):
+        if opt in opts:
+            value = opts.pop(opt)[0]
+            paging[member] = value if member == 'StartingToken' else int(value)
+    for opt, values in opts.items():
+        if opt.startswith('no-') and not values and opt[3:] in members:
+            member, shape = members[opt[3:]]
+            if shape.type_name == 'boolean':
+                params[member] = False
+                continue
+        if opt not in members:
+            sys.stderr.write("Don't know how to pass --%s to %s %s\n" % (opt, service, words[1]))
+            sys.exit(1)
+        member, shape = members[opt]
+        if shape.type_name == 'boolean' and not values:
+            params[member] = True
             continue
-        if args.verbose:
-            sys.stderr.write("VPC: %s\n" % vpc['VpcId'])
-        g = VPC(vpc, args)
-        objects[g.name] = g
+        if shape.type_name == 'integer':
+            values = [int(v) for v in values]
+        elif shape.type_name == 'list' and shape.member.type_name == 'structure':
+            values = [shorthand(v, shape.member) for v in values]
+        params[member] = values if shape.type_name == 'list' else values[0]
+
+    try:
+        if paginate and client.can_paginate(method):
+            ans = client.get_paginator(method).paginate(PaginationConfig=paging, **params).build_full_result()
+        else:
+            ans = getattr(client, method)(**params)
+    except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as exc:
+        sys.stderr.write("Failed to run %s: %s\n" % (fullcmd, exc))
+        sys.exit(1)
+    ans.pop('ResponseMetadata', None)
+    if query:
+        ans = jmespath.search(query, ans)
+    return ans
 
 
 ###############################################################################
-def get_all_instances(args):
-    if args.verbose:
-        sys.stderr.write("Getting instances\n")
-    reservation_list = ec2cmd("describe-instances")['Reservations']
-    for reservation in reservation_list:
-        for instance in reservation['Instances']:
-            i = Instance(instance, args)
-            objects[i.name] = i
-            if args.verbose:
-                sys.stderr.write("Instance: %s\n" % i.name)
+def shorthand(value, shape):
+    """ Turn the cli's shorthand for a structure - Name=vpc-id,Values=a,b -
+    into the structure """
+    ans, member = {}, None
+    for part in value.split(','):
+        if '=' in part:
+            member, _, part = part.partition('=')
+            if shape.members[member].type_name != 'list':
+                ans[member] = part
+                continue
+            ans[member] = []
+        ans[member].append(part)
+    return ans
 
 
 ###############################################################################
-def get_all_subnets(args):
-    if args.verbose:
-        sys.stderr.write("Getting subnets\n")
-    subnets = ec2cmd("describe-subnets")['Subnets']
-    for subnet in subnets:
-        if args.subnet and subnet['SubnetId'] != args.subnet:
-            pass
-        elif args.verbose:
-            sys.stderr.write("Subnet: %s\n" % subnet['SubnetId'])
-        s = Subnet(subnet, args)
-        objects[s.name] = s
+def cachename(cmd, area='ec2'):
+    """ Return the full aws command line and the file its output is cached in """
+    cachepath = '.cache'
+    try:
+        os.mkdir(cachepath)
+    except OSError as exc:    # May be racing another fetch thread
+        if exc.errno != errno.EEXIST:
+            raise
+    fullcmd = 'aws %s %s %s' % (" ".join(awsflags), area, cmd)
+    return fullcmd, os.path.join(cachepath, md5.md5(fullcmd).hexdigest())
 
 
 ###############################################################################
-def get_all_volumes(args):
-    if args.verbose:
-        sys.stderr.write("Getting volumes\n")
-    volumes = ec2cmd("describe-volumes")['Volumes']
-    for volume in volumes:
-        v = Volume(volume, args)
-        objects[v.name] = v
+def cache_write(cachefile, fullcmd, data, full=None):
+    with open(cachefile, 'w') as g:
+        g.write(data)
+    cache_meta(cachefile, fullcmd, len(data), full)
 
 
 ###############################################################################
-def get_all_security_groups(args):
-    if args.verbose:
-        sys.stderr.write("Getting security groups\n")
-    sgs = ec2cmd("describe-security-groups")['SecurityGroups']
-    for sg in sgs:
-        s = SecurityGroup(sg, args)
-        objects[s.name] = s
-        if args.verbose:
-            sys.stderr.write("SG %s\n" % s.name)
+def cache_meta(cachefile, fullcmd, size, full=None):
+    """ Record when the data was fetched, and when it was last fetched in
+    full rather than merged into by fetch_changes() """
+    now = time.time()
+    with open('%s.meta' % cachefile, 'w') as g:
+        json.dump({'fetched': now, 'full': full or now, 'command': fullcmd, 'size': size}, g)
 
 
 ###############################################################################
-def get_all_route_tables(args):
-    if args.verbose:
-        sys.stderr.write("Getting route tables\n")
-    rts = ec2cmd('describe-route-tables')['RouteTables']
-    for rt in rts:
-        r = RouteTable(rt, args)
-        objects[r.name] = r
+def awsdownload(cmd, area='ec2', ttl=None, refresh=False):
+    """ Make sure the output of an aws command is in the cache, copying it
+    there a chunk at a time rather than reading it all in - for JsonStream
+    to parse later. Returns the cache file """
+    fullcmd, cachefile = cachename(cmd, area)
+    start = time.time()
+
+    hit = not nocache and not refresh and cache_fresh(cachefile, ttl)
+    if hit:
+        size = os.path.getsize(cachefile)
+    else:
+        size = 0
+        status = None
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(cachefile))
+        with os.fdopen(fd, 'w') as g:
+            if backend == 'api':
+                data = awsoutput(fullcmd)
+                g.write(data)
+                size = len(data)
+            else:
+                f = os.popen(fullcmd)
+                for chunk in iter(lambda: f.read(JsonStream.chunksize), ''):
+                    g.write(chunk)
+                    size += len(chunk)
+                status = f.close()
+        if status or not json_document(tmpfile):
+            os.unlink(tmpfile)      # Only cache it once we know it isn't an error
+            sys.stderr.write("Failed to get json output from %s (exit status %d)\n" % (fullcmd, (status or 0) >> 8))
+            sys.exit(1)
+        os.rename(tmpfile, cachefile)
+        cache_meta(cachefile, fullcmd, size)
+
+    if profiling is not None:
+        profiling['commands'].append({
+            'command': fullcmd, 'cache': 'hit' if hit else 'miss', 'bytes': size,
+            'fetch_seconds': time.time() - start, 'json_seconds': 0})
+    return cachefile
 
 
 ###############################################################################
-def get_all_network_interfaces(args):
-    if args.verbose:
-        sys.stderr.write("Getting NICs\n")
-    nics = ec2cmd('describe-network-interfaces')['NetworkInterfaces']
-    for nic in nics:
-        n = NetworkInterface(nic, args)
-        objects[n.name] = n
+def json_document(filename):
+    """ Does the file look like a whole json object - without reading it
+    all in. A bad one in the middle is left for JsonStream to find """
+    with open(filename) as f:
+        head = f.read(JsonStream.chunksize).lstrip()
+        if not head.startswith('{'):
+            return False
+        f.seek(max(0, os.fstat(f.fileno()).st_size - JsonStream.chunksize))
+        return f.read().rstrip().endswith('}')
 
 
 ###############################################################################
-def get_all_rds(args):
+class JsonStream(object):
+    """ The items of the list under key in the json output of an aws
+    command, decoded one at a time as they are iterated over so only
+    one of them is in memory at once """
+    chunksize = 65536
+
+    def __init__(self, filename, key):
+        self.filename = filename
+        self.key = key
+
+    def __iter__(self):
+        try:
+            for item in self.items():
+                yield item
+        except ValueError as exc:
+            sys.stderr.write("Failed to decode %s from %s: %s\n" % (self.key, self.filename, exc))
+            sys.exit(1)
+
+    def items(self):
+        decoder = json.JSONDecoder()
+        marker = '"%s"' % self.key
+        with open(self.filename) as f:
+            def more(buf):
+                """ Read at least as much again as we already have, so
+                a big item isn't decoded over and over """
+                data = f.read(max(self.chunksize, len(buf)))
+                if not data:
+                    raise ValueError("unexpected end of data")
+                return buf + data
+
+            buf = ''
+            while marker not in buf:
+                buf = more(buf[-len(marker):])
+            buf = buf[buf.index(marker) + len(marker):]
+            for expected in ':[':
+                buf = buf.lstrip()
+                while not buf:
+                    buf = more(buf).lstrip()
+                if buf[0] != expected:
+                    raise ValueError("expected '%s' after %s" % (expected, marker))
+                buf = buf[1:]
+
+            while True:
+                buf = buf.lstrip()
+                while not buf:
+                    buf = more(buf).lstrip()
+                if buf[0] == ']':
+                    return
+                if buf[0] == ',':
+                    buf = buf[1:]
+                    continue
+                while True:
+                    try:
+                        item, end = decoder.raw_decode(buf)
+                        break
+                    except ValueError:
+                        buf = more(buf)
+                buf = buf[end:]
+                yield item
+
+
+###############################################################################
+def cache_fresh(cachefile, ttl=None, since='fetched'):
+    """ Is the cachefile there and less than ttl seconds old - or since
+    it was last fetched in full """
+    if not os.path.exists(cachefile):
+        return False
+    if ttl is None:
+        return True
+    try:
+        with open('%s.meta' % cachefile) as f:
+            fetched = json.load(f)[since]
+    except (IOError, ValueError, KeyError):     # Cached before we had metadata
+        fetched = os.path.getmtime(cachefile)
+    return time.time() - fetched < ttl
+
+
+###############################################################################
+def get_all_internet_gateways(args, data):
+    if args.verbose:
+        sys.stderr.write("Getting internet gateways\n")
+    for igw in data:
+        yield InternetGateway(igw, args)
+
+
+###############################################################################
+def get_vpc_list(args, data):
+    for vpc in data:
+        if args.vpc and vpc['VpcId'] != args.vpc:
+            continue
+        if args.verbose:
+            sys.stderr.write("VPC: %s\n" % vpc['VpcId'])
+        yield VPC(vpc, args)
+
+
+###############################################################################
+def get_all_instances(args, data):
+    if args.verbose:
+        sys.stderr.write("Getting instances\n")
+    for reservation in data:
+        for instance in reservation['Instances']:
+            if args.verbose:
+                sys.stderr.write("Instance: %s\n" % instance['InstanceId'])
+            yield Instance(instance, args)
+
+
+###############################################################################
+def get_all_subnets(args, data):
+    if args.verbose:
+        sys.stderr.write("Getting subnets\n")
+    for subnet in data:
+        if args.subnet and subnet['SubnetId'] != args.subnet:
+            pass
+        elif args.verbose:
+            sys.stderr.write("Subnet: %s\n" % subnet['SubnetId'])
+        yield Subnet(subnet, args)
+
+
+###############################################################################
+def get_all_volumes(args, data):
+    if args.verbose:
+        sys.stderr.write("Getting volumes\n")
+    for volume in data:
+        yield Volume(volume, args)
+
+
+###############################################################################
+def get_all_security_groups(args, data):
+    if args.verbose:
+        sys.stderr.write("Getting security groups\n")
+    for sg in data:
+        if args.verbose:
+            sys.stderr.write("SG %s\n" % sg['GroupId'])
+        yield SecurityGroup(sg, args)
+
+
+###############################################################################
+def get_all_route_tables(args, data):
+    if args.verbose:
+        sys.stderr.write("Getting route tables\n")
+    for rt in data:
+        yield RouteTable(rt, args)
+
+
+###############################################################################
+def get_all_network_interfaces(args, data):
+    if args.verbose:
+        sys.stderr.write("Getting NICs\n")
+    for nic in data:
+        yield NetworkInterface(nic, args)
+
+
+###############################################################################
+def get_all_rds(args, data):
     if args.verbose:
         sys.stderr.write("Getting Databases\n")
-    dbs = rdscmd('describe-db-instances')['DBInstances']
-    for db in dbs:
-        rds = Database(db, args)
-        objects[rds.name] = rds
+    for db in data:
         if args.verbose:
-            sys.stderr.write("RDS: %s\n" % rds.name)
+            sys.stderr.write("RDS: %s\n" % db['DBInstanceIdentifier'])
+        yield Database(db, args)
 
 
 ###############################################################################
-def get_all_elbs(args):
+def get_all_elbs(args, data):
     if args.verbose:
         sys.stderr.write("Getting Load Balancers\n")
-    elbs = elbcmd('describe-load-balancers')['LoadBalancerDescriptions']
-    for elb in elbs:
-        lb = LoadBalancer(elb, args)
-        objects[lb.name] = lb
+    for elb in data:
+        yield LoadBalancer(elb, args)
 
 
 ###############################################################################
-def get_all_networkacls(args):
+def get_all_networkacls(args, data):
     if args.verbose:
         sys.stderr.write("Getting NACLs\n")
-    nacls = ec2cmd('describe-network-acls')['NetworkAcls']
-    for nacl in nacls:
-        nc = NetworkAcl(nacl, args)
-        objects[nc.name] = nc
+    for nacl in data:
+        if args.verbose:
+            sys.stderr.write("NACL: %s\n" % nacl['NetworkAclId'])
+        yield NetworkAcl(nacl, args)
+
+
+###############################################################################
+# Each resource type: (name, aws area, describe command, result key, builder)
+resources = [
+    ('vpcs', 'ec2', 'describe-vpcs', 'Vpcs', get_vpc_list),
+    ('igws', 'ec2', 'describe-internet-gateways', 'InternetGateways', get_all_internet_gateways),
+    ('nics', 'ec2', 'describe-network-interfaces', 'NetworkInterfaces', get_all_network_interfaces),
+    ('instances', 'ec2', 'describe-instances', 'Reservations', get_all_instances),
+    ('subnets', 'ec2', 'describe-subnets', 'Subnets', get_all_subnets),
+    ('volumes', 'ec2', 'describe-volumes', 'Volumes', get_all_volumes),
+    ('routetables', 'ec2', 'describe-route-tables', 'RouteTables', get_all_route_tables),
+    ('secgroups', 'ec2', 'describe-security-groups', 'SecurityGroups', get_all_security_groups),
+    ('nacls', 'ec2', 'describe-network-acls', 'NetworkAcls', get_all_networkacls),
+    ('rds', 'rds', 'describe-db-instances', 'DBInstances', get_all_rds),
+    ('elbs', 'elb', 'describe-load-balancers', 'LoadBalancerDescriptions', get_all_elbs),
+    ]
+
+
+# How many seconds the cached data for each resource type is good for
+cachettl = {
+    'vpcs': 4 * 3600,
+    'igws': 4 * 3600,
+    'nics': 300,
+    'instances': 300,
+    'subnets': 4 * 3600,
+    'volumes': 1800,
+    'routetables': 3600,
+    'secgroups': 1800,
+    'nacls': 4 * 3600,
+    'rds': 1800,
+    'elbs': 1800,
+    }
+
+
+# The describe filters that limit each type to a vpc or subnet. Instances
+# and subnets outside the subnet are still looked up when drawing, as are
+# the other vpcs an igw is attached to, security groups are only limited
+# to a vpc if one was asked for, and volumes, elbs and rds can't be
+# filtered this way
+vpcfilters = {
+    'igws': 'attachment.vpc-id', 'nics': 'vpc-id', 'instances': 'vpc-id',
+    'subnets': 'vpc-id', 'routetables': 'vpc-id', 'nacls': 'vpc-id',
+    }
+subnetfilters = {'nics': 'subnet-id', 'nacls': 'association.subnet-id'}
+vpcloads = ('volumes', 'elbs', 'rds')     # Can't be fetched by vpc, but can be loaded from the inventory by it
+
+
+###############################################################################
+def scope_vpc(args, scope=''):
+    """ Return the vpc the map is limited to - looking it up if we were
+    only given a subnet, or an instance for a security map. None if it
+    isn't limited or they aren't in this profile/region """
+    if args.vpc:
+        return args.vpc
+    if args.subnet:
+        rtype, rid, area, cmd = 'subnets', args.subnet, 'Subnets', 'describe-subnets --filters Name=subnet-id,Values=%s'
+    elif args.secmap:
+        rtype, rid, area, cmd = 'instances', args.secmap, 'Reservations', 'describe-instances --filters Name=instance-id,Values=%s'
+    else:
+        return None
+    if args.inventory:
+        vpcs = inventory_refs(args.inventory, scope, rtype, rid, 'VpcId')
+        if vpcs:
+            return vpcs[0]
+    found = resource_items(rtype, awscmd(cmd % rid, ttl=cachettl.get(rtype))[area])
+    if found:
+        return found[0]['VpcId']
+    return None
+
+
+###############################################################################
+def scope_limit(name, args, vpc):
+    """ Return the (vpc, subnet) that a resource type is limited to when it
+    is fetched - '' if it isn't """
+    limit = ['', '']
+    if vpc and name in vpcfilters:
+        limit[0] = vpc
+    elif args.vpc and name in ('vpcs', 'secgroups'):
+        limit[0] = args.vpc
+    if vpc and args.subnet and name in subnetfilters:
+        limit[1] = args.subnet
+    return tuple(limit)
+
+
+###############################################################################
+def scoped_resource(res, args, vpc):
+    """ Return the resource with filters added to its command so only the
+    ones in the vpc or subnet we are mapping are fetched - and cached
+    separately from the unfiltered ones """
+    name, area, cmd, key, builder = res
+    limitvpc, limitsubnet = scope_limit(name, args, vpc)
+    filters = []
+    if limitvpc:
+        filters.append("Name=%s,Values=%s" % (vpcfilters.get(name, 'vpc-id'), limitvpc))
+    if limitsubnet:
+        filters.append("Name=%s,Values=%s" % (subnetfilters[name], limitsubnet))
+    if filters:
+        cmd = "%s --filters %s" % (cmd, " ".join(filters))
+    return name, area, cmd, key, builder
+
+
+###############################################################################
+# Resource types that can be refreshed by only fetching what has changed:
+#   name: (query to list them, option to describe some, id key, listing of a cached one)
+# Security groups aren't here as listing their rules costs as much as
+# describing them
+incremental = {
+    'instances': (
+        'Reservations[].Instances[].[InstanceId,State.Name,LaunchTime,SecurityGroups[].GroupId,Tags]',
+        '--instance-ids', 'InstanceId',
+        lambda i: [i['InstanceId'], i['State']['Name'], i['LaunchTime'],
+                   [g['GroupId'] for g in i.get('SecurityGroups', [])], i.get('Tags')]),
+    'volumes': (
+        'Volumes[].[VolumeId,State,Attachments[].InstanceId,Tags]', '--volume-ids', 'VolumeId',
+        lambda v: [v['VolumeId'], v['State'], [a['InstanceId'] for a in v['Attachments']], v.get('Tags')]),
+    }
+
+
+###############################################################################
+def fetch_resource(job):
+    """ Fetch the raw data for one resource type - run from a worker thread
+    so exit on failure is turned into None for fetch_all() to handle
+
+    Returns the data and what changed since the last fetch - as data
+    of the same shape and a list of removed ids, or None if everything
+    has been refetched """
+    res, args, scope, vpc = job
+    name, area, cmd, key, builder = res
+    ttl = cachettl.get(name)
+    refresh = name in args.refresh
+    fullcmd, cachefile = cachename(cmd, area)
+    try:
+        limit = scope_limit(name, args, vpc)
+        if args.inventory and not nocache and not refresh and inventory_fresh(args.inventory, scope, name, limit, ttl):
+            if vpc and name in vpcloads:
+                limit = (vpc, '')
+            return InventoryRows(args.inventory, scope, name, limit), ([], [])
+        if args.pagesize:
+            return fetch_pages(res, args)
+        if not nocache and not refresh and cache_fresh(cachefile, ttl):
+            if args.stream:
+                return JsonStream(awsdownload(cmd, area, ttl), key), ([], [])
+            return awscmd(cmd, area, ttl)[key], ([], [])
+        if args.incremental and name in incremental and not nocache and not refresh \
+                and cache_fresh(cachefile, args.incremental, 'full'):
+            return fetch_changes(res, args)
+        if args.stream:
+            return JsonStream(awsdownload(cmd, area, ttl, refresh=True), key), None
+        return awscmd(cmd, area, ttl, refresh=True)[key], None
+    except SystemExit:
+        return None
+
+
+###############################################################################
+# The smallest and largest page each service will return for every describe
+# call we make - bigger pages are made up of several calls
+pagelimits = {'ec2': (5, 100), 'rds': (20, 100), 'elb': (1, 400)}
+
+
+###############################################################################
+def fetch_pages(res, args):
+    """ Fetch a resource type --pagesize at a time, retrying a page that
+    fails, and caching each page by itself so if the fetch fails part way
+    through a rerun carries on from the page it got to
+
+    Returns the pages to be read one at a time, and whether they all came
+    from the cache in the same way as fetch_resource() """
+    name, area, cmd, key, builder = res
+    ttl = cachettl.get(name)
+    refresh = name in args.refresh
+    low, high = pagelimits[area]
+    pagesize = min(max(args.pagesize, low), high)
+    pagecmd = "%s --max-items %d --page-size %d" % (cmd, args.pagesize, pagesize)
+    pages, token, allcached = [], None, True
+    while True:
+        thiscmd = pagecmd if token is None else "%s --starting-token '%s'" % (pagecmd, token)
+        fullcmd, cachefile = cachename(thiscmd, area)
+        cached = not nocache and not refresh and cache_fresh(cachefile, ttl)
+        for attempt in range(args.retries):
+            try:
+                page = awscmd(thiscmd, area, ttl, refresh=refresh or attempt > 0)
+                break
+            except SystemExit:
+                if attempt == args.retries - 1:
+                    raise
+                sys.stderr.write("Retrying page %d of %s\n" % (len(pages) + 1, name))
+                time.sleep(2 ** attempt)
         if args.verbose:
-            sys.stderr.write("NACL: %s\n" % nc.name)
+            sys.stderr.write("%s: page %d, %d items\n" % (name, len(pages) + 1, len(page[key])))
+        allcached = allcached and cached
+        pages.append(cachefile)
+        token = page.get('NextToken')
+        if not token:
+            break
+    return PagedItems(pages, key, args.stream), ([], []) if allcached else None
+
+
+###############################################################################
+class PagedItems(object):
+    """ The items of a resource type that was fetched a page at a time,
+    read back from the cache a page at a time """
+    def __init__(self, pagefiles, key, stream=False):
+        self.pagefiles = pagefiles
+        self.key = key
+        self.stream = stream
+
+    def __iter__(self):
+        for pagefile in self.pagefiles:
+            if self.stream:
+                items = JsonStream(pagefile, self.key)
+            else:
+                with open(pagefile) as f:
+                    items = json.load(f)[self.key]
+            for item in items:
+                yield item
+
+
+###############################################################################
+def resource_items(name, data):
+    """ Instances come wrapped in reservations - everything else is a list """
+    if name == 'instances':
+        return [i for r in data for i in r['Instances']]
+    return data
+
+
+###############################################################################
+def fetch_changes(res, args):
+    """ List the ids of a resource type and only describe those that are new
+    or have changed since they were cached, then merge them into the cache """
+    name, area, cmd, key, builder = res
+    query, idopt, idkey, listing = incremental[name]
+    fullcmd, cachefile = cachename(cmd, area)
+    with open(cachefile) as f:
+        cached = dict((i[idkey], i) for i in resource_items(name, json.load(f)[key]))
+
+    current = awscmd("%s --query '%s'" % (cmd, query), area, usecache=False)
+    current = dict((c[0], c) for c in current)
+    removed = [x for x in cached if x not in current]
+    changed = [x for x in current if x not in cached or listing(cached[x]) != current[x]]
+    if args.verbose:
+        sys.stderr.write("%s: %d changed, %d removed\n" % (name, len(changed), len(removed)))
+
+    fresh = []
+    for start in range(0, len(changed), 200):
+        idlist = " ".join(changed[start:start + 200])
+        fresh.extend(awscmd('%s %s %s' % (cmd, idopt, idlist), area, usecache=False)[key])
+
+    freshids = set(i[idkey] for i in resource_items(name, fresh))
+    kept = [cached[x] for x in sorted(current) if x in cached and x not in freshids]
+    if name == 'instances':
+        kept = [{'Instances': [i]} for i in kept]
+    data = kept + fresh
+    try:
+        with open('%s.meta' % cachefile) as f:
+            full = json.load(f)['full']
+    except (IOError, ValueError, KeyError):     # Cached before we recorded it
+        full = os.path.getmtime(cachefile)
+    cache_write(cachefile, fullcmd, json.dumps({key: data}), full)
+    return data, (fresh, removed)
+
+
+###############################################################################
+def fetch_all(args, scope=''):
+    """ Run all the describe commands in parallel as they are independent
+    of each other - so we only wait as long as the slowest one
+
+    Returns the data and changes of each resource type, and what they
+    were limited to when fetched """
+    vpc = scope_vpc(args, scope)
+    pool = ThreadPool(max(1, args.jobs))
+    try:
+        results = pool.map(fetch_resource, [(scoped_resource(res, args, vpc), args, scope, vpc) for res in resources])
+    finally:
+        pool.close()
+        pool.join()
+    if None in results:
+        sys.exit(1)
+    names = [r[0] for r in resources]
+    limits = [scope_limit(name, args, vpc) for name in names]
+    return dict(zip(names, [r[0] for r in results])), dict(zip(names, [r[1] for r in results])), dict(zip(names, limits))
+
+
+###############################################################################
+def build_index():
+    """ Work out who is related to who once, rather than each object
+    having to search through all the others when drawing """
+    for idx in (attached, subnetassoc, sgmembers, bytype):
+        idx.clear()
+    for obj in sorted(objects.values(), key=lambda o: o.sortkey):
+        bytype.setdefault(obj.__class__, []).append(obj)
+        for instid in obj.attachedTo():
+            attached.setdefault(scopedkey(obj.scope, instid), []).append(obj)
+        for subnet in obj.subnetAssociations():
+            subnetassoc.setdefault(scopedkey(obj.scope, subnet), []).append(obj)
+        for sg in obj.securityGroups():
+            sgmembers.setdefault(scopedkey(obj.scope, sg), []).append(obj)
+
+
+###############################################################################
+def get_scopes(args):
+    """ Return the (scope, awsflags) of each profile/region combination
+    to map - a single unnamed scope if none were asked for """
+    regions = args.region.split(',') if args.region else [None]
+    profiles = args.profile.split(',') if args.profile else [None]
+    scopes = []
+    for profile in profiles:
+        for region in regions:
+            flags = awsflags[:]
+            if profile:
+                flags.append('--profile %s' % profile)
+            if region:
+                flags.append('--region %s' % region)
+            name = "/".join([x for x in (profile, region) if x])
+            scopes.append((name, flags))
+    if len(scopes) == 1:
+        return [('', scopes[0][1])]
+    return scopes
+
+
+###############################################################################
+def fetch_scope(job):
+    """ Fetch everything for one profile/region - run from a worker process """
+    global awsflags
+    scope, flags, args = job
+    awsflags = flags
+    if profiling is not None:   # Workers get reused for other profile/regions
+        del profiling['commands'][:]
+    try:
+        return fetch_all(args, scope), profiling['commands'] if profiling else []
+    except SystemExit:
+        return None
+
+
+###############################################################################
+def map_region(args, fetched=None, scope=''):
+    """ Build the objects for a profile/region - if they have already been
+    built only rebuild those that have changed since """
+    if fetched is None:
+        with phase('fetch'):
+            fetched = fetch_all(args, scope)
+    data, changes, limits = fetched
+    with phase('build %s' % scope if scope else 'build'):
+        build_region(args, data, changes, scope)
+    if args.inventory:
+        with phase('inventory %s' % scope if scope else 'inventory'):
+            save_inventory(args.inventory, scope, data, limits)
+
+
+###############################################################################
+def build_region(args, data, changes, scope=''):
+    for name, area, cmd, key, builder in resources:
+        built = typekeys.setdefault((scope, name), set())
+        if changes[name] is None or not built:
+            stale, source = list(built), data[name]
+        else:
+            source, removed = changes[name]
+            stale = [scopedkey(scope, x) for x in removed]
+        newobjs = []
+        for obj in builder(args, source):
+            obj.scope = scope
+            newobjs.append(obj)
+            stale.append(obj.key)
+        for k in stale:
+            objects.pop(k, None)
+            built.discard(k)
+        for obj in newobjs:
+            objects[obj.key] = obj
+            built.add(obj.key)
+
+
+###############################################################################
+def inventory_connect(dbfile):
+    """ Open the inventory, creating its tables if need be. Each resource
+    type has a table of its data, and refs and tags index them by the
+    vpcs, subnets, instances and security groups they are part of and
+    their tag keys """
+    db = sqlite3.connect(dbfile, timeout=60)
+    db.execute("CREATE TABLE IF NOT EXISTS fetched (scope TEXT, type TEXT, vpc TEXT, subnet TEXT, time REAL, PRIMARY KEY (scope, type, vpc, subnet))")
+    db.execute("CREATE TABLE IF NOT EXISTS refs (scope TEXT, type TEXT, id TEXT, kind TEXT, ref TEXT)")
+    db.execute("CREATE INDEX IF NOT EXISTS refs_ref ON refs (scope, kind, ref, type)")
+    db.execute("CREATE INDEX IF NOT EXISTS refs_id ON refs (scope, type, id)")
+    db.execute("CREATE TABLE IF NOT EXISTS tags (scope TEXT, type TEXT, id TEXT, key TEXT, value TEXT)")
+    db.execute("CREATE INDEX IF NOT EXISTS tags_key ON tags (scope, key, value)")
+    db.execute("CREATE INDEX IF NOT EXISTS tags_id ON tags (scope, type, id)")
+    for res in resources:
+        db.execute("CREATE TABLE IF NOT EXISTS %s (scope TEXT, id TEXT, data TEXT, PRIMARY KEY (scope, id))" % res[0])
+    return db
+
+
+###############################################################################
+def inventory_where(scope, name, limit):
+    """ Return the sql condition, and its parameters, that picks the ids of
+    the resources of a type within the (vpc, subnet) limit """
+    where, params = ["scope = ?"], [scope]
+    for kind, ref in zip(('VpcId', 'SubnetId'), limit):
+        if not ref:
+            continue
+        if name == 'volumes':   # Are in the vpc and subnet of the instances they are attached to
+            where.append(
+                "id IN (SELECT v.id FROM refs v JOIN refs i ON i.scope = v.scope AND i.id = v.ref"
+                " WHERE v.scope = ? AND v.kind = 'InstanceId' AND v.type = ? AND i.kind = ? AND i.ref = ? AND i.type = 'instances')")
+            params.extend([scope, name, kind, ref])
+        else:
+            where.append("id IN (SELECT id FROM refs WHERE scope = ? AND kind = ? AND ref = ? AND type = ?)")
+            params.extend([scope, kind, ref, name])
+    return " AND ".join(where), params
+
+
+###############################################################################
+def inventory_fresh(dbfile, scope, name, limit, ttl=None):
+    """ Is there a fetch of the resource type that covers the limit in the
+    inventory that is younger than ttl """
+    db = inventory_connect(dbfile)
+    try:
+        vpc, subnet = limit
+        fetched = db.execute(
+            "SELECT MAX(time) FROM fetched WHERE scope = ? AND type = ? AND vpc IN ('', ?) AND subnet IN ('', ?)",
+            (scope, name, vpc, subnet)).fetchone()[0]
+    finally:
+        db.close()
+    if fetched is None:
+        return False
+    return ttl is None or time.time() - fetched < ttl
+
+
+###############################################################################
+def inventory_refs(dbfile, scope, name, rid, kind):
+    """ Return what a resource in the inventory is indexed by """
+    db = inventory_connect(dbfile)
+    try:
+        rows = db.execute(
+            "SELECT ref FROM refs WHERE scope = ? AND type = ? AND id = ? AND kind = ?", (scope, name, rid, kind))
+        return [r[0] for r in rows]
+    finally:
+        db.close()
+
+
+###############################################################################
+class InventoryRows(object):
+    """ The data of the resources of a type within a (vpc, subnet) limit,
+    read from the inventory as they are iterated over - in the same shape
+    as the aws output so the get_all_* functions can build them """
+    def __init__(self, dbfile, scope, name, limit):
+        self.dbfile = dbfile
+        self.scope = scope
+        self.name = name
+        self.limit = limit
+
+    def __iter__(self):
+        db = inventory_connect(self.dbfile)
+        try:
+            where, params = inventory_where(self.scope, self.name, self.limit)
+            for (data, ) in db.execute("SELECT data FROM %s WHERE %s ORDER BY id" % (self.name, where), params):
+                item = json.loads(data)
+                if self.name == 'instances':
+                    item = {'Instances': [item]}
+                yield item
+        finally:
+            db.close()
+
+
+###############################################################################
+def save_inventory(dbfile, scope, data, limits):
+    """ Replace what was fetched of each resource type in the inventory with
+    the objects the get_all_* functions built from it """
+    db = inventory_connect(dbfile)
+    with db:
+        for name, area, cmd, key, builder in resources:
+            if isinstance(data[name], InventoryRows):
+                continue
+            where, params = inventory_where(scope, name, limits[name])
+            ids = [(scope, r[0]) for r in db.execute("SELECT id FROM %s WHERE %s" % (name, where), params)]
+            db.executemany("DELETE FROM %s WHERE scope = ? AND id = ?" % name, ids)
+            for table in ('refs', 'tags'):
+                db.executemany("DELETE FROM %s WHERE scope = ? AND type = '%s' AND id = ?" % (table, name), ids)
+
+            objs = [objects[k] for k in typekeys.get((scope, name), ())]
+            db.executemany(
+                "INSERT OR REPLACE INTO %s VALUES (?, ?, ?)" % name,
+                [(scope, obj.name, json.dumps(obj.data())) for obj in objs])
+            db.executemany(
+                "INSERT INTO refs VALUES (?, ?, ?, ?, ?)",
+                [(scope, name, obj.name, kind, ref) for obj in objs for kind, ref in obj.refs()])
+            db.executemany(
+                "INSERT INTO tags VALUES (?, ?, ?, ?, ?)",
+                [(scope, name, obj.name, k, v) for obj in objs for k, v in sorted((obj.tags() or {}).items())])
+            db.execute("INSERT OR REPLACE INTO fetched VALUES (?, ?, ?, ?, ?)", (scope, name) + limits[name] + (time.time(), ))
+    db.close()
+
+
+###############################################################################
+def map_all(args):
+    """ Map every profile/region asked for, fetching them in parallel.
+    Returns True if anything changed since the last time """
+    return build_all(args, fetch_scopes(args))
 
 
 ###############################################################################
-def map_region(args):
-    # EC2
-    get_vpc_list(args)
-    get_all_internet_gateways(args)
-    get_all_network_interfaces(args)
-    get_all_instances(args)
-    get_all_subnets(args)
-    get_all_volumes(args)
-    get_all_route_tables(args)
-    get_all_security_groups(args)
-    get_all_networkacls(args)
+def fetch_scopes(args):
+    """ Fetch every profile/region asked for in parallel, returning the
+    (scope, fetched) of each """
+    global awsflags
+    scopes = get_scopes(args)
+    if len(scopes) == 1:
+        awsflags = scopes[0][1]
+        with phase('fetch'):
+            return [('', fetch_all(args))]
+    wargs = copy.copy(args)
+    wargs.output = None     # File handles can't go to the workers
+    with phase('fetch'):
+        pool = multiprocessing.Pool(min(len(scopes), args.procs))
+        try:
+            results = pool.map(fetch_scope, [(scope, flags, wargs) for scope, flags in scopes])
+        finally:
+            pool.close()
+            pool.join()
+    if None in results:
+        sys.exit(1)
+    ans = []
+    for (scope, flags), (fetched, commands) in zip(scopes, results):
+        if profiling is not None:
+            profiling['commands'].extend(commands)
+        ans.append((scope, fetched))
+    return ans
 
-    # RDS
-    get_all_rds(args)
 
-    # ELB
-    get_all_elbs(args)
+###############################################################################
+def build_all(args, fetched):
+    """ Build the objects of each fetched profile/region and index them.
+    Returns True if anything changed since they were last built """
+    changed = False
+    for scope, (data, changes, limits) in fetched:
+        if args.verbose and scope:
+            sys.stderr.write("Mapping %s\n" % scope)
+        map_region(args, (data, changes, limits), scope)
+        changed = changed or any([c != ([], []) for c in changes.values()])
+    with phase('index'):
+        build_index()
+    return changed
 
 
 ###############################################################################
-def parseArgs():
+def parseArgs(argv=None):
     global nocache
     global awsflags
+    global backend
     parser = argparse.ArgumentParser()
     parser.add_argument(
         '--awsflag', default=None, help="Flags to pass to aws calls [None]")
+    parser.add_argument(
+        '--region', default=None,
+        help="Comma separated list of regions to map [aws default]")
+    parser.add_argument(
+        '--profile', default=None,
+        help="Comma separated list of aws profiles (accounts) to map [aws default]")
+    parser.add_argument(
+        '--procs', default=multiprocessing.cpu_count(), type=int,
+        help="How many profile/regions to fetch at once [%d]" % multiprocessing.cpu_count())
+    parser.add_argument(
+        '--perscope', default=False, action='store_true',
+        help="Create a different map for each profile/region")
     parser.add_argument(
         '--vpc', default=None, help="Which VPC to examine [all]")
     parser.add_argument(
@@ -1142,29 +2767,116 @@ def parseArgs():
     parser.add_argument(
         '--iterate', default=None, choices=['vpc', 'subnet'],
         help="Create different maps for each vpc or subnet")
+    parser.add_argument(
+        '--backend', default='cli', choices=['cli', 'api'],
+        help="Run the aws cli for each call or make the calls in process with boto3 [cli]")
+    parser.add_argument(
+        '--jobs', default=len(resources), type=int,
+        help="How many aws calls to run at once [%d]" % len(resources))
     parser.add_argument(
         '--nocache', default=False, action='store_true',
         help="Don't read from cache'd data")
+    parser.add_argument(
+        '--refresh', default='',
+        help="Comma separated list of resource types to refetch (%s)" % ",".join([r[0] for r in resources]))
+    parser.add_argument(
+        '--ttl', default='',
+        help="Comma separated list of type=seconds to keep cache'd data for")
+    parser.add_argument(
+        '--incremental', default=0, nargs='?', const=86400, type=int, metavar='SECONDS',
+        help="Only fetch the %s that have changed when refreshing the cache, "
+        "unless they were last fetched in full SECONDS ago [86400]" % ", ".join(sorted(incremental)))
+    parser.add_argument(
+        '--inventory', default=None,
+        help="Keep what is fetched in this sqlite database and load just what is mapped from it while it is fresh")
+    parser.add_argument(
+        '--diff', default=None, nargs=2, metavar=('OLD', 'NEW'),
+        help="Map what changed between two --inventory databases instead")
+    parser.add_argument(
+        '--serve', default=None, metavar='[HOST:]PORT',
+        help="Serve maps over http, e.g. /map.svg?vpc=vpc-123&security=1, instead")
+    parser.add_argument(
+        '--interval', default=300, type=int,
+        help="How often to refetch with --serve in seconds - subject to --ttl [300]")
+    parser.add_argument(
+        '--pagesize', default=None, type=int,
+        help="Fetch and cache each type this many at a time [all at once]")
+    parser.add_argument(
+        '--retries', default=3, type=int,
+        help="How many times to try each page with --pagesize [3]")
+    parser.add_argument(
+        '--stream', default=False, action='store_true',
+        help="Decode the aws output one resource at a time to save memory")
+    parser.add_argument(
+        '--budget', default=None, type=int,
+        help="Split the map up by --partition once it has more than this many objects and edges [no limit]")
+    parser.add_argument(
+        '--partition', default='vpc', choices=['vpc', 'az', 'stack'],
+        help="What to split the map up by - vpc, availability zone or cloudformation stack [vpc]")
     parser.add_argument(
         '--output', default=sys.stdout, type=argparse.FileType('w'),
         help="Which file to output to [stdout]")
+    parser.add_argument(
+        '--format', default=None,
+        help="Comma separated list of formats (%s) to run the map through graphviz to" % ",".join(graphvizFormats))
     parser.add_argument(
         '--security', default=False, action='store_true',
         help="Draw in security groups")
     parser.add_argument(
         '--secmap', default=None,
         help="Draw a security map for specified ec2")
+    parser.add_argument(
+        '--ip', default=None,
+        help="Comma separated list of ips to report what covers them")
+    parser.add_argument(
+        '--classify', default=None, type=argparse.FileType('r'),
+        help="Report the subnet, vpc and route of each ip in this file (- for stdin)")
+    parser.add_argument(
+        '--reach', default=None, type=argparse.FileType('r'),
+        help="Report whether the security groups allow each 'source destination port[/protocol]' in this file (- for stdin)")
+    parser.add_argument(
+        '--nacl', default=None, type=argparse.FileType('r'),
+        help="Report whether the network acls allow each 'source destination port[/protocol]' or flow log record in this file (- for stdin)")
+    parser.add_argument(
+        '--route', default=None, type=argparse.FileType('r'),
+        help="Report where the traffic of each 'source destination' in this file (- for stdin) is routed")
+    parser.add_argument(
+        '--profiling', default=None, nargs='?', const='-',
+        help="Write timings, memory use and counts as json to this file [stderr]")
     parser.add_argument(
         '-v', '--verbose', default=False, action='store_true',
         help="Print some details")
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     nocache = args.nocache
+    backend = args.backend
+    if backend == 'api' and boto3 is None:
+        parser.error("--backend api needs boto3")
+    types = [r[0] for r in resources]
+    args.refresh = [x for x in args.refresh.split(',') if x]
+    for rtype in args.refresh:
+        if rtype not in types:
+            parser.error("Unknown resource type %s for --refresh" % rtype)
+    for ttl in [x for x in args.ttl.split(',') if x]:
+        try:
+            rtype, secs = ttl.split('=')
+            cachettl[rtype] = int(secs)
+        except ValueError:
+            parser.error("--ttl should be type=seconds not %s" % ttl)
+        if rtype not in types:
+            parser.error("Unknown resource type %s for --ttl" % rtype)
+    if args.retries < 1:
+        parser.error("--retries should be at least 1")
     if args.vpc and not args.vpc.startswith('vpc-'):
         args.vpc = "vpc-%s" % args.vpc
     if args.subnet and not args.subnet.startswith('subnet-'):
         args.subnet = "subnet-%s" % args.subnet
     if args.awsflag:
         awsflags = ["--%s" % args.awsflag]
+    if args.format:
+        args.format = args.format.split(',')
+        for fmt in args.format:
+            if fmt not in graphvizFormats:
+                parser.error("Unknown format %s" % fmt)
     return args
 
 
@@ -1181,91 +2893,634 @@ def generateFooter(fh):
 
 
 ###############################################################################
-def generate_secmap(ec2, fh):
+def generate_secmap(ec2, fh, args):
     """ Generate a security map instead """
+    fh = DotFile(fh, args)
     generateHeader(fh)
-    subnet = objects[ec2]['SubnetId']
-    vpc = objects[ec2]['VpcId']
+    inst = objects[ec2]
+    subnet = inst['SubnetId']
+    vpc = inst['VpcId']
 
     # The ec2
-    objects[ec2].drawSec(fh)
+    inst.drawSec(fh)
 
     # Security groups associated with the ec2
-    for sg in objects[ec2]['SecurityGroups']:
-        secGrpToDraw.add(sg['GroupId'])
-        objects[sg['GroupId']].drawSec(fh)
+    for sg in inst['SecurityGroups']:
+        fh.secgroups.add(sg['GroupId'])
+        inst.obj(sg['GroupId']).drawSec(fh)
 
     # Subnet ec2 is on
-    subnet = objects[ec2]['SubnetId']
-    objects[subnet].drawSec(fh)
+    inst.obj(subnet).drawSec(fh)
 
     # NACLs and RTs associated with that subnet
-    for obj in objects.values():
-        if obj.__class__ in (NetworkAcl, RouteTable):
-            for assoc in obj['Associations']:
-                if 'SubnetId' in assoc and assoc['SubnetId'] == subnet:
-                    obj.drawSec(fh)
-                    fh.write("%s -> %s\n" % (obj.mn(), objects[subnet].mn()))
-            continue
-        if obj.__class__ in (Database, ):
-            for sg in obj['VpcSecurityGroups']:
-                if sg['VpcSecurityGroupId'] in secGrpToDraw:
-                    obj.drawSec(fh)
+    for obj in subnetassoc.get(inst.obj(subnet).key, []):
+        obj.drawSec(fh)
+        fh.write("%s -> %s\n" % (obj.mn(), inst.obj(subnet).mn()))
+
+    # Databases in any of the security groups
+    dbs = set()
+    for sg in list(fh.secgroups):
+        for obj in sgmembers.get(scopedkey(inst.scope, sg), []):
+            if obj.__class__ in (Database, ) and obj.key not in dbs:
+                dbs.add(obj.key)
+                obj.drawSec(fh)
 
     # VPC that the EC2 is in
-    objects[vpc].drawSec(fh)
+    inst.obj(vpc).drawSec(fh)
 
     # Finish any referred to SG
-    for sg in list(secGrpToDraw):
-        if not objects[sg].drawn:
-            objects[sg].drawSec(fh)
+    for sg in list(fh.secgroups):
+        if sg not in fh.drawn:
+            inst.obj(sg).drawSec(fh)
 
     generateFooter(fh)
+    fh.flush()
+    return fh.objcounts, fh.edgecounts
+
+
+###############################################################################
+drawOrder = [VPC, InternetGateway, Subnet, RouteTable, NetworkAcl, Database, LoadBalancer,
+             Instance, NetworkInterface, Volume, SecurityGroup]
+rankOrder = [Database, LoadBalancer, Subnet, Instance, VPC, InternetGateway, RouteTable]
 
 
 ###############################################################################
-def generate_map(fh, args):
+def generate_map(fh, args, scope=None, only=None, highlight=None, stub=None):
+    """ Map all the objects - or only those from one profile/region, or
+    with a key in only. highlight has extra dot attributes for some of
+    the objects. Objects not in only that are linked to are drawn with
+    the (comment, attributes) from stub(obj, args) if given """
+    fh = DotFile(fh, args)
     generateHeader(fh)
 
-    # Draw all the objects
-    for obj in sorted(objects.values()):
-        if obj.__class__ == SecurityGroup:
-            if not args.security:
+    # Draw all the objects, ranking them as we go
+    rankings = {}
+    for objtype in drawOrder:
+        if objtype == SecurityGroup and not args.security:
+            continue
+        ranking = rankings[objtype] = DotFile(None, args)
+        for obj in bytype.get(objtype, []):
+            if scope is not None and obj.scope != scope:
+                continue
+            if only is not None and obj.key not in only:
                 continue
-        obj.draw(fh)
+            writes = fh.writes
+            obj.draw(fh)
+            if fh.writes != writes:
+                fh.count(fh.objcounts, obj)
+            if objtype in rankOrder:
+                obj.rank(ranking)
+
+    for key, (comment, attrs) in sorted((highlight or {}).items()):
+        fh.write('// %s\n' % comment)
+        fh.write('%s [%s];\n' % (objects[key].mn(), attrs))
+
+    if stub is not None and only is not None:
+        for key in sorted(fh.linked - only):
+            if key in objects:
+                comment, attrs = stub(objects[key], args)
+                fh.write('// %s\n' % comment)
+                fh.write('%s [%s];\n' % (objects[key].mn(), attrs))
 
     # Assign Ranks
-    for objtype in [Database, LoadBalancer, Subnet, Instance, VPC, InternetGateway, RouteTable]:
+    for objtype in rankOrder:
         fh.write('// Rank %s\n' % objtype.__name__)
         fh.write('rank_%s [style=invisible]\n' % objtype.__name__)
         fh.write('{ rank=same; rank_%s; ' % objtype.__name__)
-        for obj in sorted(objects.values()):
-            if obj.__class__ == objtype:
-                obj.rank(fh)
+        fh.write(rankings[objtype].getvalue())
         fh.write('}\n')
     ranks = ['RouteTable', 'Subnet', 'Database', 'LoadBalancer', 'Instance', 'VPC', 'InternetGateway']
     strout = " -> ".join(["rank_%s" % x for x in ranks])
     fh.write("%s [style=invis];\n" % strout)
 
     generateFooter(fh)
+    fh.flush()
+    return fh.objcounts, fh.edgecounts
+
+
+###############################################################################
+def load_snapshot(dbfile, args):
+    """ Build the objects in an inventory - those in --vpc if given """
+    snapshot = {}
+    db = inventory_connect(dbfile)
+    scopes = [r[0] for r in db.execute("SELECT DISTINCT scope FROM fetched ORDER BY scope")]
+    db.close()
+    for scope in scopes:
+        for name, area, cmd, key, builder in resources:
+            for obj in builder(args, InventoryRows(dbfile, scope, name, (args.vpc or '', ''))):
+                obj.scope = scope
+                snapshot[obj.key] = obj
+    return snapshot
+
+
+###############################################################################
+def diff_snapshots(old, new):
+    """ Return the keys of the objects added and removed between two
+    snapshots, and the fields that changed of those in both """
+    added = [k for k in new if k not in old]
+    removed = [k for k in old if k not in new]
+    changed = {}
+    for k in new:
+        if k not in old:
+            continue
+        olddata, newdata = old[k].data(), new[k].data()
+        fields = [f for f in set(olddata) | set(newdata) if olddata.get(f) != newdata.get(f)]
+        if fields:
+            changed[k] = sorted(fields)
+    return added, removed, changed
+
+
+###############################################################################
+diffColours = {'added': 'palegreen', 'removed': 'lightpink', 'changed': 'gold'}
+
+
+###############################################################################
+def generate_diff(fh, args):
+    """ Map only what changed between two inventories, and what it is
+    directly connected to, highlighted by how it changed """
+    old, new = [load_snapshot(dbfile, args) for dbfile in args.diff]
+    added, removed, changed = diff_snapshots(old, new)
+    objects.clear()
+    objects.update(new)
+    for k in removed:
+        objects[k] = old[k]
+    build_index()
+
+    highlight = {}
+    for change, keys in (('added', added), ('removed', removed), ('changed', changed)):
+        for k in keys:
+            label = "%s %s" % (change, k)
+            attrs = 'style=filled, fillcolor=%s, shape=box' % diffColours[change]
+            if change == 'changed':
+                label += ": %s" % ", ".join(changed[k])
+                attrs += ', xlabel="%s"' % "\\n".join(changed[k])
+            highlight[k] = (label, attrs)
+    if args.verbose:
+        sys.stderr.write("%d added, %d removed, %d changed\n" % (len(added), len(removed), len(changed)))
+
+    # The changes and everything they refer to or that refers to them
+    marked = set(highlight)
+    only = set(marked)
+    for obj in objects.values():
+        refs = set([scopedkey(obj.scope, ref) for kind, ref in obj.refs()])
+        if obj.key in marked:
+            only.update([k for k in refs if k in objects])
+        elif refs & marked:
+            only.add(obj.key)
+    dargs = copy.copy(args)
+    dargs.security = True       # Changes to security groups need them drawn
+    return generate_map(fh, dargs, only=only, highlight=highlight)
+
+
+###############################################################################
+def partition_of(obj, how):
+    """ Which part of a map split up by vpc, availability zone or
+    cloudformation stack an object is drawn in """
+    for instid in obj.attachedTo():     # Is drawn with its instance
+        if scopedkey(obj.scope, instid) in objects:
+            return partition_of(obj.obj(instid), how)
+    if how == 'stack':
+        return scopedkey(obj.scope, obj.tags('aws:cloudformation:stack-name') or 'nostack')
+    if how == 'az':
+        subnets = [objects.get(scopedkey(obj.scope, s)) for s in obj.subnetIds()]
+        zones = sorted(set([s['AvailabilityZone'] for s in subnets if s is not None]))
+        if zones:
+            return scopedkey(obj.scope, zones[0])
+    if isinstance(obj, VPC):
+        return obj.key
+    return scopedkey(obj.scope, (obj.vpcIds() or ['novpc'])[0])
+
+
+###############################################################################
+def partition_file(label, args):
+    """ The file to link to for the map of a partition - the svg if it is
+    one of the --format, as only they can be clicked through, otherwise
+    the first --format, or the dot file if there isn't any """
+    basename = re.sub(r'/', '_', label)
+    if args.format and 'svg' in args.format:
+        return "%s.svg" % basename
+    if args.format:
+        return "%s.%s" % (basename, args.format[0])
+    return "%s.dot" % basename
+
+
+###############################################################################
+def partition_stub(obj, args):
+    """ The comment and dot attributes of an object in another partition
+    that one is linked to """
+    other = partition_of(obj, args.partition)
+    return "In %s" % other, 'shape=box, style=dashed, label="%s\\n%s", URL="%s"' % (
+        obj.name, other, partition_file(other, args))
+
+
+###############################################################################
+def map_size(args):
+    """ Roughly how many objects and edges a map would have - counted from
+    the objects and what they refer to rather than by drawing it """
+    size = 0
+    for objtype in drawOrder:
+        if objtype == SecurityGroup and not args.security:
+            continue
+        for obj in bytype.get(objtype, []):
+            owner = obj         # Attached objects are drawn with their instance
+            for instid in obj.attachedTo():
+                owner = objects.get(scopedkey(obj.scope, instid), owner)
+            if args.vpc and args.vpc not in owner.vpcIds():
+                continue
+            if args.subnet and args.subnet not in owner.subnetIds():
+                continue
+            size += 1
+            if isinstance(obj, NetworkAcl):
+                continue        # Only a comment
+            for kind, ref in obj.refs():
+                if ref == obj.name or (kind == 'GroupId' and not args.security):
+                    continue
+                if kind == 'VpcId' and not isinstance(obj, (Subnet, InternetGateway)):
+                    continue    # Others are linked to their subnets rather than the vpc
+                if owner is not obj and kind not in ('InstanceId', 'GroupId'):
+                    continue
+                size += 1
+    return size
+
+
+###############################################################################
+def output_partitioned(args):
+    """ Write the map as usual if it has no more than --budget objects and
+    edges - otherwise a map of each --partition, with the objects they
+    are linked to in other partitions as dashed boxes, and an overview
+    map of how the partitions refer to each other """
+    size = map_size(args)
+    if size <= args.budget:
+        record_counts(output_map(lambda fh: generate_map(fh, args), args))
+        return
+
+    parts = {}          # label -> keys of the objects in it
+    partof = {}         # key -> label
+    for obj in objects.values():
+        label = partition_of(obj, args.partition)
+        parts.setdefault(label, set()).add(obj.key)
+        partof[obj.key] = label
+    if args.verbose:
+        sys.stderr.write("Map has %d objects and edges, splitting it by %s into %d\n" % (size, args.partition, len(parts)))
+
+    links = {}          # (label, label) -> references between them
+    jobs, labels = [], {}
+    for label in sorted(parts):
+        for key in parts[label]:
+            obj = objects[key]
+            if [i for i in obj.attachedTo() if scopedkey(obj.scope, i) in objects]:
+                continue
+            for kind, ref in obj.refs():
+                other = partof.get(scopedkey(obj.scope, ref), label)
+                if other == label or (kind == 'GroupId' and not args.security):
+                    continue
+                pair = tuple(sorted((label, other)))
+                links[pair] = links.get(pair, 0) + 1
+        filename = '%s.dot' % re.sub(r'/', '_', label)
+        labels[filename] = label
+        jobs.append((filename, args, None, parts[label], None, partition_stub))
+
+    sizes = {}
+    for filename, (objcounts, edgecounts) in render_all(jobs, args):
+        sizes[labels[filename]] = sum(objcounts.values()) + sum(edgecounts.values())
+        if sizes[labels[filename]] > args.budget:
+            sys.stderr.write("%s is still over --budget with %d objects and edges\n" % (filename, sizes[labels[filename]]))
+    record_counts(output_map(lambda fh: generate_overview(fh, args, sizes, links), args))
+
+
+###############################################################################
+def generate_overview(fh, args, sizes, links):
+    """ Map the partitions of a split up map and the references between
+    them, each linking to the map of that partition """
+    fh = DotFile(fh, args)
+    generateHeader(fh)
+    for label, size in sorted(sizes.items()):
+        fh.write('"%s" [shape=box, label="%s\\n%d objects and edges", URL="%s"];\n' % (
+            label, label, size, partition_file(label, args)))
+    for (a, b), count in sorted(links.items()):
+        fh.write('"%s" -> "%s" [dir=none, label="%d"];\n' % (a, b, count))
+    generateFooter(fh)
+    fh.flush()
+    return fh.objcounts, fh.edgecounts
+
+
+###############################################################################
+def render_one(job):
+    """ Draw one map to its own file - run from a worker process. Only the
+    filename, args and scope of a job are needed """
+    filename, args, scope, only, highlight, stub = job + (None,) * (6 - len(job))
+    counts = output_map(lambda fh: generate_map(fh, args, scope, only, highlight, stub), args, filename)
+    return filename, counts
+
+
+###############################################################################
+def output_map(generate, args, filename=None):
+    """ Write the map drawn by generate(fh) to filename (or --output) - or
+    feed it straight into graphviz if we were asked for any --format """
+    if not args.format:
+        if filename:
+            with open(filename, 'w') as f:
+                return generate(f)
+        return generate(args.output)
+    buf = StringIO.StringIO()
+    ans = generate(buf)
+    if filename:
+        graphviz(buf.getvalue(), args.format, os.path.splitext(filename)[0])
+    elif args.output == sys.stdout and len(args.format) > 1:
+        graphviz(buf.getvalue(), args.format, 'aws-map')
+    elif len(args.format) > 1:
+        graphviz(buf.getvalue(), args.format, os.path.splitext(args.output.name)[0])
+    else:
+        graphviz(buf.getvalue(), args.format, fh=args.output)
+    return ans
+
+
+###############################################################################
+def graphviz(dot, formats, basename=None, fh=None):
+    """ Run dot once for each format at the same time - writing the output
+    to basename.format, or to fh if there is only one format """
+    procs = []
+    for fmt in formats:
+        cmd = ['dot', '-T%s' % fmt]
+        if fh:
+            procs.append(subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=fh))
+        else:
+            cmd.extend(['-o', '%s.%s' % (basename, fmt)])
+            procs.append(subprocess.Popen(cmd, stdin=subprocess.PIPE))
+    pool = ThreadPool(len(procs))
+    try:
+        pool.map(lambda p: p.communicate(dot), procs)
+    finally:
+        pool.close()
+        pool.join()
+    for fmt, proc in zip(formats, procs):
+        if proc.returncode:
+            sys.stderr.write("dot failed to generate %s output\n" % fmt)
+            sys.exit(1)
+
+
+###############################################################################
+def graphviz_data(dot, fmt):
+    """ Run dot and return what it generates """
+    proc = subprocess.Popen(['dot', '-T%s' % fmt], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    out, err = proc.communicate(dot)
+    if proc.returncode:
+        sys.stderr.write("dot failed to generate %s output\n" % fmt)
+        sys.exit(1)
+    return out
+
+
+###############################################################################
+def render_all(jobs, args):
+    """ Draw a lot of maps in parallel - the workers are forked so they all
+    share the one inventory and only the (filename, args, scope[, only,
+    highlight, stub]) is passed. Returns the (filename, counts) of each """
+    jobs = [(job[0], copy.copy(job[1])) + tuple(job[2:]) for job in jobs]
+    for job in jobs:
+        job[1].output = None     # File handles can't go to the workers - only clear them on copies
+    if args.procs <= 1 or len(jobs) <= 1:
+        done = map(render_one, jobs)
+    else:
+        pool = multiprocessing.Pool(min(len(jobs), args.procs))
+        try:
+            done = pool.map(render_one, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    for filename, counts in done:
+        record_counts(counts)
+        if args.verbose:
+            sys.stderr.write("Wrote %s\n" % filename)
+    return done
+
+
+###############################################################################
+class MapServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Serve maps of the objects over http, refetching them in the
+    background every --interval seconds. The maps drawn are kept until
+    something changes in the objects """
+    daemon_threads = True
+    contentTypes = {'dot': 'text/vnd.graphviz', 'svg': 'image/svg+xml', 'png': 'image/png', 'pdf': 'application/pdf'}
+
+    def __init__(self, address, args):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MapHandler)
+        self.args = args
+        self.lock = threading.Lock()    # Held while the objects are changed or drawn
+        self.version = 0                # Of the objects - bumped whenever they change
+        self.renders = {}               # (format, query) -> (etag, content type, body)
+
+    def digests(self):
+        """ What each object was built from, to tell if any have changed """
+        return dict([(k, o.digest()) for k, o in objects.items()])
+
+    def refresher(self):
+        while True:
+            time.sleep(self.args.interval)
+            try:
+                fetched = fetch_scopes(self.args)
+            except SystemExit:
+                sys.stderr.write("Failed to refresh the objects, will try again\n")
+                continue
+            with self.lock:
+                before = self.digests()
+                build_all(self.args, fetched)
+                if self.digests() != before:    # Refetching the same data isn't a change
+                    self.version += 1
+                    self.renders.clear()
+                    if self.args.verbose:
+                        sys.stderr.write("Objects changed, now version %d\n" % self.version)
+
+    def render(self, fmt, query):
+        """ Return the (etag, content type, body) of a map - KeyError if
+        it is of something we don't know about """
+        key = (fmt, tuple(sorted(query.items())))
+        with self.lock:
+            if key in self.renders:
+                return self.renders[key]
+            margs = copy.copy(self.args)
+            margs.output, margs.format = None, None
+            margs.vpc, margs.subnet, margs.secmap = query.get('vpc'), query.get('subnet'), query.get('secmap')
+            margs.security = query.get('security', '') not in ('', '0', 'no', 'false')
+            if margs.vpc and not margs.vpc.startswith('vpc-'):
+                margs.vpc = "vpc-%s" % margs.vpc
+            if margs.subnet and not margs.subnet.startswith('subnet-'):
+                margs.subnet = "subnet-%s" % margs.subnet
+            for name in (margs.vpc, margs.subnet):
+                if name and name not in objects:
+                    raise KeyError(name)
+            buf = StringIO.StringIO()
+            if margs.secmap:
+                generate_secmap(margs.secmap, buf, margs)
+            else:
+                generate_map(buf, margs)
+            version = self.version
+        body = buf.getvalue()
+        if fmt != 'dot':
+            body = graphviz_data(body, fmt)
+        ans = ('"%s"' % md5.md5(body).hexdigest(), self.contentTypes[fmt], body)
+        with self.lock:
+            if self.version == version:
+                self.renders[key] = ans
+        return ans
+
+
+###############################################################################
+class MapHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ GET /map.FORMAT?vpc=...&subnet=...&secmap=...&security=1 """
+    queryKeys = ('vpc', 'subnet', 'secmap', 'security')
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        name, _, fmt = url.path.lstrip('/').partition('.')
+        if name != 'map' or fmt not in self.server.contentTypes:
+            self.send_error(404, "Only /map.{%s} is served" % ",".join(sorted(self.server.contentTypes)))
+            return
+        query = dict(urlparse.parse_qsl(url.query))
+        for k in query:
+            if k not in self.queryKeys:
+                self.send_error(400, "Unknown parameter %s" % k)
+                return
+        try:
+            etag, ctype, body = self.server.render(fmt, query)
+        except KeyError as exc:
+            self.send_error(404, "Unknown %s" % exc)
+            return
+        except SystemExit:
+            self.send_error(500, "Failed to draw the map")
+            return
+        except OSError as exc:      # dot is missing or couldn't be run
+            self.send_error(500, "Failed to run dot: %s" % exc)
+            return
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.args.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+###############################################################################
+def serve(args):
+    """ Serve maps until we are killed """
+    host, _, port = args.serve.rpartition(':')
+    server = MapServer((host or '127.0.0.1', int(port)), args)
+    refresher = threading.Thread(target=server.refresher)
+    refresher.daemon = True
+    refresher.start()
+    if args.verbose:
+        sys.stderr.write("Serving maps on http://%s:%d/map.svg\n" % server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+###############################################################################
+@contextlib.contextmanager
+def phase(name):
+    """ Record how long the code in the with block takes when profiling """
+    if profiling is None:
+        yield
+        return
+    start = time.time()
+    startrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    yield
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    profiling['phases'].append({
+        'phase': name, 'seconds': time.time() - start,
+        'process_maxrss_kb': maxrss,
+        'maxrss_growth_kb': maxrss - startrss})
+
+
+###############################################################################
+def record_counts(counts):
+    """ Add the (objects, edges) drawn per class to the profile """
+    if profiling is None or not counts:
+        return
+    for total, count in zip((profiling['objects'], profiling['edges']), counts):
+        for name, num in count.items():
+            total[name] = total.get(name, 0) + num
+
+
+###############################################################################
+def write_profile(dest):
+    profiling['maxrss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    profiling['children_maxrss_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if dest == '-':
+        json.dump(profiling, sys.stderr, indent=2, sort_keys=True)
+        sys.stderr.write("\n")
+    else:
+        with open(dest, 'w') as f:
+            json.dump(profiling, f, indent=2, sort_keys=True)
 
 
 ###############################################################################
 def main():
+    global profiling
     args = parseArgs()
-    map_region(args)
+    if args.profiling:
+        profiling = {'phases': [], 'commands': [], 'objects': {}, 'edges': {}}
+    if args.diff:
+        with phase('diff'):
+            record_counts(output_map(lambda fh: generate_diff(fh, args), args))
+    elif args.serve:
+        map_all(args)
+        serve(args)
+    else:
+        with phase('map'):
+            map_all(args)
+        with phase('output'):
+            output(args)
+    if profiling is not None:
+        write_profile(args.profiling)
+
+
+###############################################################################
+def output(args):
+    if args.ip:
+        query_ip(args.output, args.ip.split(','))
+        return
+    if args.classify:
+        classify_ips(args.output, args.classify)
+        return
+    if args.reach:
+        query_reach(args.output, args.reach)
+        return
+    if args.nacl:
+        query_nacls(args.output, args.nacl)
+        return
+    if args.route:
+        query_routes(args.output, args.route)
+        return
     if args.secmap:
-        generate_secmap(args.secmap, args.output)
+        record_counts(output_map(lambda fh: generate_secmap(args.secmap, fh, args), args))
         return
     if args.iterate:
-        for o in objects.keys():
-            if o.startswith(args.iterate):
-                f = open('%s.dot' % o, 'w')
-                setattr(args, args.iterate, o)
-                generate_map(f, args)
-                f.close()
+        jobs = []
+        for o in sorted(objects.values(), key=lambda o: o.sortkey):
+            if o.name.startswith(args.iterate):
+                margs = copy.copy(args)
+                setattr(margs, args.iterate, o.name)
+                jobs.append(('%s.dot' % re.sub(r'/', '_', o.key), margs, o.scope, None, None))
+        render_all(jobs, args)
+    elif args.perscope:
+        jobs = []
+        for scope, flags in get_scopes(args):
+            jobs.append(('%s.dot' % re.sub(r'/', '_', scope or 'default'), args, scope, None, None))
+        render_all(jobs, args)
+    elif args.budget:
+        output_partitioned(args)
     else:
-        generate_map(args.output, args)
+        record_counts(output_map(lambda fh: generate_map(fh, args), args))
 
 ###############################################################################
 if __name__ == '__main__':
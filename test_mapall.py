@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+#
+# Checks of how mapall draws the synthetic inventory from benchmark.py
+# Run with: python -m unittest test_mapall
+
+import os
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+import benchmark
+import mapall
+
+
+###############################################################################
+class TestSecurityMap(unittest.TestCase):
+    """ Build a small synthetic account from the .cache like benchmark.py """
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp(prefix='aws-map-test-')
+        os.chdir(self.tmpdir)
+        benchmark.write_cache(benchmark.generate(20))
+        benchmark.reset()
+        self.args = mapall.parseArgs(['--procs', '1'])
+        mapall.map_all(self.args)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def test_nic_groups_with_volumes(self):
+        """ --security links the nics of instances that have volumes to
+        their security groups """
+        self.args.security = True
+        buf = StringIO.StringIO()
+        mapall.generate_map(buf, self.args)
+        edges = set(buf.getvalue().splitlines())
+        checked = 0
+        for nic in mapall.bytype.get(mapall.NetworkInterface, []):
+            instids = nic.attachedTo()
+            if not instids or not [o for o in mapall.attached.get(instids[0], []) if isinstance(o, mapall.Volume)]:
+                continue
+            for sg in nic.securityGroups():
+                self.assertIn("%s -> %s ;" % (nic.mn(), nic.mn(sg)), edges)
+                checked += 1
+        self.assertTrue(checked)
+
+
+###############################################################################
+if __name__ == '__main__':
+    unittest.main()
+
+#EOF